@@ -4,7 +4,7 @@ License: MIT, see LICENSE for details
 """
 
 from flask import Flask
-from faceoff import config, log, cache, db, fixtures, tpl
+from faceoff import config, log, cache, db, fixtures, tpl, writer, profiler
 
 __all__ = ['app']
 
@@ -15,5 +15,8 @@ cache.init_app(app)
 db.init_app(app)
 fixtures.init_app(app)
 tpl.init_app(app)
+writer.init_app(app)
+profiler.init_app(app)
 
 import faceoff.views  # flake8: noqa
+import faceoff.api  # flake8: noqa
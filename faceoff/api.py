@@ -0,0 +1,205 @@
+"""
+Versioned JSON API for wall displays, chat bots and other automated clients.
+Every endpoint lives under `/api/<version>/` and answers with JSON built from
+the same model functions as the HTML pages.
+
+Clients authenticate with an existing session or with HTTP basic auth using
+their nickname and password. Responses to GET requests carry the same
+validators as the league pages, so polling clients can revalidate them with
+`If-None-Match` and get a 304 while nothing has changed. The `fields`
+parameter limits the fields returned for each record, and match history is
+paged with the opaque `cursor` returned by the previous page.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+import json
+from functools import wraps
+from flask import g, request, session
+from werkzeug.datastructures import MultiDict
+from faceoff import app
+from faceoff.forms import ReportForm
+from faceoff.helpers.decorators import readonly, conditional
+from faceoff.models.user import get_user_snapshot, check_login, find_user_id
+from faceoff.models.match import get_league_ranking, search_matches
+from faceoff.export import export_matches, MIMETYPES
+from faceoff.writer import ReportTimeout
+
+API_PREFIX = '/api/v1'
+
+STANDING_FIELDS = (
+    'user_id', 'nickname', 'rank', 'wins', 'losses', 'games', 'win_streak',
+    'loss_streak', 'mu', 'sigma')
+
+MATCH_FIELDS = (
+    'id', 'date_created', 'winner_id', 'winner_nickname', 'winner_rank',
+    'loser_id', 'loser_nickname', 'loser_rank', 'draw_prob')
+
+MATCH_LIMIT = 20
+MATCH_LIMIT_MAX = 100
+
+
+class APIError(Exception):
+    """
+    Aborts an API request with a JSON error response.
+    """
+
+    def __init__(self, message, status=400):
+        super(APIError, self).__init__(message)
+        self.status = status
+
+
+def api_view(f):
+    """
+    Authenticates API requests and turns `APIError` into a JSON error
+    response. Unlike `authenticated`, anonymous requests get a 401 instead
+    of a redirect to the gate.
+    """
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        user_id = session.get('user_id')
+        auth = request.authorization
+        if auth is not None:
+            user_id = check_login(auth.username, auth.password)
+        user = None if user_id is None else get_user_snapshot(user_id)
+        if user is None:
+            response = error('authentication required', 401)
+            response.headers['WWW-Authenticate'] = 'Basic realm="faceoff"'
+            return response
+        g.current_user = user
+        try:
+            return f(*args, **kwargs)
+        except APIError as e:
+            return error(e.message, e.status)
+    return decorator
+
+
+@app.route(API_PREFIX + '/<league>/standings')
+@readonly
+@api_view
+@conditional
+def api_standings():
+    fields = get_fields(STANDING_FIELDS)
+    ranking = get_league_ranking(g.current_league['id'])
+    return respond(standings=[select(r, fields) for r in ranking])
+
+
+@app.route(API_PREFIX + '/<league>/matches')
+@readonly
+@api_view
+@conditional
+def api_matches():
+    fields = get_fields(MATCH_FIELDS)
+    user_id = None
+    nickname = request.args.get('user')
+    if nickname:
+        user_id = find_user_id(nickname)
+        if user_id is None:
+            raise APIError('unknown user: %s' % nickname, 404)
+    try:
+        limit = int(request.args.get('limit', MATCH_LIMIT))
+    except ValueError:
+        raise APIError('limit must be a number')
+    limit = max(1, min(limit, MATCH_LIMIT_MAX))
+    try:
+        result = search_matches(
+            g.current_league['id'], user_id=user_id, per_page=limit,
+            seek=True, token=request.args.get('cursor') or None)
+    except ValueError:
+        raise APIError('invalid cursor')
+    return respond(
+        matches=[select(m, fields) for m in result['row_data']],
+        next_cursor=result['next_token'])
+
+
+@app.route(API_PREFIX + '/<league>/matches', methods=('POST',))
+@api_view
+def api_report():
+    """
+    Reports a match played by the current user. Takes the `opponent` user
+    ID and a `result` of 1 for a win or 0 for a loss, as form fields or a
+    JSON object.
+    """
+    if not g.current_league['active']:
+        raise APIError('league is inactive', 403)
+    data = request.json if request.json is not None else request.form
+    if not isinstance(data, dict):
+        raise APIError('expected a JSON object')
+    form = ReportForm(g.current_user['id'], MultiDict(
+        dict((k, unicode(v)) for (k, v) in data.items())))
+    if not form.validate():
+        return respond(400, error='invalid report', fields=form.errors)
+    cur_user = g.current_user['id']
+    opp_user = form.opponent.data
+    if form.result.data == '1':
+        (winner, loser) = (cur_user, opp_user)
+    else:
+        (winner, loser) = (opp_user, cur_user)
+    try:
+        match_id = app.writer.report(g.current_league['id'], winner, loser)
+    except ReportTimeout:
+        raise APIError('match was not recorded, try again', 503)
+    except ValueError as e:
+        raise APIError(str(e))
+    return respond(201, id=match_id, winner_id=winner, loser_id=loser)
+
+
+@app.route(API_PREFIX + '/<league>/export.<format>')
+@readonly
+@api_view
+def api_export(format):
+    """
+    Streams the entire match history of the league, oldest first, as `csv`
+    or `ndjson`.
+    """
+    if format not in MIMETYPES:
+        raise APIError('unknown format: %s' % format, 404)
+    league = g.current_league
+
+    def generate():
+        # the request connection is released as soon as the view returns,
+        # before the response is streamed, so the export reads through a
+        # connection of its own.
+        db = app.db.connect(readonly=True)
+        try:
+            for chunk in export_matches(db, league['id'], format):
+                yield chunk
+        finally:
+            db.close()
+    response = app.response_class(generate(), mimetype=MIMETYPES[format])
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=%s.%s' % (league['slug'], format)
+    return response
+
+
+def get_fields(allowed):
+    """
+    Returns the fields requested with the comma separated `fields`
+    parameter, or every `allowed` field if none were requested.
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+    fields = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise APIError('unknown fields: %s' % ', '.join(unknown))
+    return fields
+
+
+def select(record, fields):
+    return dict((f, record.get(f)) for f in fields)
+
+
+def respond(status=200, **data):
+    """
+    Returns a compact JSON response.
+    """
+    return app.response_class(
+        json.dumps(data, separators=(',', ':')), status=status,
+        mimetype='application/json')
+
+
+def error(message, status):
+    return respond(status, error=message)
@@ -3,13 +3,327 @@ Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
 License: MIT, see LICENSE for details
 """
 
-from werkzeug.contrib.cache import NullCache, MemcachedCache
+import json
+import cPickle as pickle
+from time import time
+from random import randint
+from hashlib import sha1
+from functools import wraps
+from threading import Lock
+from logging import getLogger
+from collections import OrderedDict
+from flask import g, has_request_context
+from werkzeug.contrib.cache import BaseCache, MemcachedCache
+from faceoff.db import Connection
+from faceoff.models.generation import get_generation, bump_generation
+
+# how long namespace versions are kept. a version that expires is replaced by
+# a new random one, which simply invalidates its namespace.
+VERSION_TIMEOUT = 60 * 60 * 24 * 7
+
+_global_cache = None
 
 
 def init_app(app):
     """
-    Configures the provided app cache services.
+    Configures the provided app cache services. Values are cached in a
+    bounded in-process LRU, in front of memcached when servers are configured
+    and a memcache client library is installed.
     """
     servers = app.config['MEMCACHED_SERVERS']
-    servers = filter(None, servers.split(',') if servers is str else servers)
-    app.cache = MemcachedCache(servers) if servers else NullCache()
+    if isinstance(servers, basestring):
+        servers = servers.split(',')
+    servers = filter(None, [s.strip() for s in servers or []])
+    remote = None
+    if servers:
+        try:
+            remote = MemcachedCache(
+                servers, key_prefix=app.config['CACHE_KEY_PREFIX'])
+        except RuntimeError:
+            logger().warning('no memcache library found, caching in memory')
+    local = LocalCache(
+        max_entries=app.config['CACHE_LOCAL_ENTRIES'],
+        max_bytes=app.config['CACHE_LOCAL_BYTES'])
+    app.cache = Cache(local, remote, app.config['CACHE_TIMEOUT'],
+                      app.config['CACHE_LOCAL_TIMEOUT'])
+    set_global_cache(app.cache)
+
+
+def get_global_cache():
+    """
+    Returns the global cache. Use `set_global_cache` to set this value when
+    the application initializes.
+    """
+    return _global_cache
+
+
+def set_global_cache(cache):
+    """
+    Sets the global cache used by `cached` model functions.
+    """
+    global _global_cache
+    _global_cache = cache
+
+
+def cached(name, namespace=None, timeout=None):
+    """
+    Decorator that caches the results of a model function. The cache key is
+    made of `name` and the call arguments, leaving out the database
+    connection. If a `namespace` is given, the first argument identifies the
+    namespace the result belongs to (eg: a league id) and the result is
+    invalidated by bumping its version with `bump_version`.
+    """
+    def closure(f):
+        @wraps(f)
+        def decorator(*args, **kwargs):
+            cache = get_global_cache()
+            if cache is None:
+                return f(*args, **kwargs)
+            params = args
+            db = kwargs.get('db')
+            if params and isinstance(params[0], Connection):
+                (db, params) = (params[0], params[1:])
+            params = (params, dict(
+                (k, v) for (k, v) in kwargs.iteritems() if k != 'db'))
+            version = 0
+            if namespace is not None:
+                version = cache.version(
+                    '%s:%s' % (namespace, params[0][0]), db)
+            key = cache.make_key(name, version, params)
+            return cache.load(name, key, lambda: f(*args, **kwargs),
+                              timeout, versioned=namespace is not None)
+        return decorator
+    return closure
+
+
+def bump_version(namespace, *instances, **kwargs):
+    """
+    Invalidates everything cached under the given namespace instances, eg:
+    `bump_version('league', league_id, db=db)`. The `db` connection is used
+    to store the new versions when there is no remote cache.
+    """
+    cache = get_global_cache()
+    if cache is None:
+        return
+    for instance in instances:
+        cache.bump('%s:%s' % (namespace, instance), kwargs.get('db'))
+
+
+class Cache(object):
+    """
+    Two tier read-through cache. Values are looked up in the process `local`
+    cache first and then in the optional `remote` cache shared by all
+    processes, which is queried in batches by `get_many`.
+
+    Values are stored under versioned namespaces, so that bumping a
+    namespace version makes every value cached under it unreachable.
+    Namespace versions are only ever read from the remote cache, or from the
+    generation table of the database when there is no remote cache, which
+    keeps every process coherent, while the values themselves never change
+    under a given version and can be kept locally for as long as they are
+    cached.
+    Keeps hit and miss counters for each cached function.
+    """
+
+    def __init__(self, local, remote=None, timeout=300, local_timeout=10):
+        self.local = local
+        self.remote = remote
+        self.timeout = timeout
+        self.local_timeout = local_timeout
+        self.counters = {}
+        self.lock = Lock()
+
+    def get(self, key, local_timeout=None):
+        """
+        Looks up a value in the local cache and then the remote cache. Values
+        found remotely are kept locally for `local_timeout` seconds.
+        """
+        return self.get_many(key, local_timeout=local_timeout)[0]
+
+    def get_many(self, *keys, **kwargs):
+        """
+        Looks up several values, fetching the ones missing from the local
+        cache from the remote cache in a single request.
+        """
+        values = [self.local.get(key) for key in keys]
+        missing = [i for (i, value) in enumerate(values) if value is None]
+        if not missing or self.remote is None:
+            return values
+        found = self.remote.get_many(*[keys[i] for i in missing])
+        local_timeout = kwargs.get('local_timeout') or self.local_timeout
+        for (i, value) in zip(missing, found):
+            if value is not None:
+                self.local.set(keys[i], value, local_timeout)
+                values[i] = value
+        return values
+
+    def set(self, key, value, timeout=None, local_timeout=None):
+        """
+        Stores a value in both cache tiers.
+        """
+        timeout = timeout or self.timeout
+        local_timeout = min(timeout, local_timeout or self.local_timeout)
+        self.local.set(key, value, local_timeout)
+        if self.remote is not None:
+            self.remote.set(key, value, timeout)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.remote is not None:
+            self.remote.delete(key)
+
+    def load(self, name, key, loader, timeout=None, versioned=False):
+        """
+        Returns the value cached at `key`, calling `loader` to produce and
+        cache the value on a miss. A `versioned` value never changes, so it
+        is kept locally for as long as it is cached.
+        """
+        local_timeout = (timeout or self.timeout) if versioned else None
+        # values are boxed so that a cached None isn't mistaken for a miss.
+        found = self.get(key, local_timeout)
+        self.count(name, found is not None)
+        if found is not None:
+            return found[0]
+        value = loader()
+        self.set(key, (value,), timeout, local_timeout)
+        return value
+
+    def make_key(self, name, version, params):
+        digest = sha1(json.dumps(params, default=repr)).hexdigest()
+        return '%s:%s:%s' % (name, version, digest)
+
+    def version(self, namespace, db=None):
+        """
+        Returns the current version of a namespace. Versions are read once per
+        request, from the remote cache or, without one, from the
+        `cache:<namespace>` generation through the `db` connection.
+        """
+        key = 'version:%s' % namespace
+        memo = self.request_versions()
+        if memo is not None and key in memo:
+            return memo[key]
+        if self.remote is None:
+            version = get_generation('cache:%s' % namespace, db=db)
+        else:
+            version = self.remote.get(key)
+            if version is None:
+                version = self.reset(key, self.remote)
+        if memo is not None:
+            memo[key] = version
+        return version
+
+    def bump(self, namespace, db=None):
+        """
+        Moves a namespace to a new version. Remote versions are random, since
+        they need no atomic increment, and a version that was evicted from the
+        cache can't come back as one that old values are still cached under.
+        Without a remote cache, the generation of the namespace is bumped in
+        the `db` connection instead, as part of its transaction.
+        """
+        key = 'version:%s' % namespace
+        memo = self.request_versions()
+        if memo is not None:
+            memo.pop(key, None)
+        if self.remote is not None:
+            self.reset(key, self.remote)
+        else:
+            bump_generation('cache:%s' % namespace, db=db)
+
+    def reset(self, key, store):
+        version = randint(1, 2 ** 62)
+        store.set(key, version, VERSION_TIMEOUT)
+        return version
+
+    def request_versions(self):
+        if not has_request_context():
+            return None
+        if not hasattr(g, 'cache_versions'):
+            g.cache_versions = {}
+        return g.cache_versions
+
+    def count(self, name, hit):
+        with self.lock:
+            counter = self.counters.setdefault(name, {'hits': 0, 'misses': 0})
+            counter['hits' if hit else 'misses'] += 1
+
+    def get_stats(self):
+        """
+        Returns the hit and miss counters of each cached function.
+        """
+        with self.lock:
+            return [dict(name=name, **counter) for (name, counter)
+                    in sorted(self.counters.iteritems())]
+
+
+class LocalCache(BaseCache):
+    """
+    Bounded in-process LRU cache. Holds at most `max_entries` values that
+    take at most `max_bytes` in total, evicting the least recently used
+    values first. Values are stored pickled, so that callers can't modify a
+    cached value and so that its size is known.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024,
+                 default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            (expires, data) = item
+            if expires <= time():
+                self.size -= len(data)
+                return None
+            self.items[key] = item
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self._remove(key)
+            if len(data) > self.max_bytes:
+                return False
+            self.items[key] = (time() + timeout, data)
+            self.size += len(data)
+            while len(self.items) > self.max_entries or \
+                    self.size > self.max_bytes:
+                (_, (_, evicted)) = self.items.popitem(last=False)
+                self.size -= len(evicted)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self.lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+        return True
+
+    def _remove(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= len(item[1])
+        return item is not None
+
+
+def logger():
+    """
+    Returns the cache logger.
+    """
+    return getLogger('cache')
@@ -19,12 +19,36 @@ LOG_PATH = os.getenv('FACEOFF_LOG_PATH')
 LOG_FILTER = os.getenv('FACEOFF_LOG_FILTER')
 LOG_IGNORE = os.getenv('FACEOFF_LOG_IGNORE')
 
-# memcache
-MEMCACHED_SERVERS = 'localhost:1121'
+# cache
+MEMCACHED_SERVERS = os.getenv('FACEOFF_MEMCACHED_SERVERS', '')
+CACHE_KEY_PREFIX = 'faceoff:'
+CACHE_TIMEOUT = 300  # seconds
+CACHE_LOCAL_TIMEOUT = 10  # seconds, for unversioned remote values
+CACHE_LOCAL_ENTRIES = 1000
+CACHE_LOCAL_BYTES = 16 * 1024 * 1024
+
+# match reports
+REPORT_BATCH_WINDOW = 0.05  # seconds
+REPORT_BATCH_SIZE = 50
+REPORT_TIMEOUT = 30  # seconds
+REPORT_OPPONENTS = 50  # listed in the form, the rest are searched
+REPORT_RECENT_OPPONENTS = 10
 
 # database
 DB_PATH = os.getenv('FACEOFF_DB_PATH')
 DB_FIXTURES = os.getenv('FACEOFF_DB_FIXTURES')
+DB_TRACE = os.getenv('FACEOFF_DB_TRACE') == '1'
+DB_POOL_SIZE = 5
+DB_CACHED_STATEMENTS = 100
+DB_JOURNAL_MODE = 'wal'
+DB_SYNCHRONOUS = 'normal'
+DB_BUSY_TIMEOUT = 5000  # milliseconds
+DB_CACHE_SIZE = -8000  # negative values are in KiB, positive in pages
+DB_MMAP_SIZE = 64 * 1024 * 1024
+
+# sql profiler
+SQL_PROFILER = os.getenv('FACEOFF_SQL_PROFILER') == '1'
+SQL_SLOW_THRESHOLD = 0.1  # seconds
 
 
 def init_app(app):
@@ -9,21 +9,24 @@ import sqlite3
 import atexit
 import string
 import logging
+import json
 from math import ceil
-from threading import current_thread
+from threading import current_thread, Lock
 from tempfile import gettempdir
-from contextlib import closing
+from contextlib import closing, contextmanager
 from glob import glob
 from uuid import uuid4, uuid5
 from hashlib import sha1
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from random import random, shuffle
 from time import time
-from natsort import natsorted
 from functools import wraps
 
 _curdir = os.path.dirname(__file__)
 _schema = os.path.join(_curdir, 'schema')
 _global_factory = None
+_sql_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_sql_list = re.compile(r'IN\s*\([^()]*\)', re.IGNORECASE)
 
 
 def init_app(app):
@@ -39,8 +42,21 @@ def init_app(app):
             db_path = make_new_db(db_path)
     else:
         db_path = make_temp_db()
-    app.db = Factory(db_path)
+    migrate_schema(db_path, _schema)
+    app.db = Factory(
+        db_path,
+        pool_size=app.config['DB_POOL_SIZE'],
+        cached_statements=app.config['DB_CACHED_STATEMENTS'],
+        pragmas=[
+            ('journal_mode', app.config['DB_JOURNAL_MODE']),
+            ('synchronous', app.config['DB_SYNCHRONOUS']),
+            ('busy_timeout', app.config['DB_BUSY_TIMEOUT']),
+            ('cache_size', app.config['DB_CACHE_SIZE']),
+            ('mmap_size', app.config['DB_MMAP_SIZE'])],
+        trace=app.config['DB_TRACE'] or app.config['SQL_PROFILER'])
     set_global_factory(app.db)
+    if app.db.trace:
+        atexit.register(query_stats.log)
 
 
 def make_temp_db():
@@ -89,12 +105,85 @@ def build_schema(db_path, schema_path):
         conn.executescript(get_schema_sql(schema_path))
 
 
+def migrate_schema(db_path, schema_path):
+    """
+    Brings an existing database up to date by running every schema file newer
+    than its `schema_version` setting. The files are applied in a single
+    immediate transaction so that processes starting at the same time wait
+    for each other instead of applying a file twice.
+    """
+    applied = []
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    with closing(conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = get_schema_version(conn)
+            for path in get_schema_files(schema_path):
+                version = os.path.basename(path)[:-len('.sql')]
+                if parse_version(version) <= parse_version(current):
+                    continue
+                with open(path) as f:
+                    for statement in split_sql(f.read()):
+                        conn.execute(statement)
+                applied.append(version)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    for version in applied:
+        logger().info('applied schema %s to %s' % (version, db_path))
+    return applied
+
+
+def get_schema_version(conn):
+    """
+    Returns the schema version of the database, or `0` when the database has
+    no schema yet.
+    """
+    query = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    if conn.execute(query, ['setting']).fetchone() is None:
+        return '0'
+    query = "SELECT value FROM setting WHERE name='schema_version'"
+    row = conn.execute(query).fetchone()
+    return '0' if row is None else row[0]
+
+
+def parse_version(version):
+    """
+    Turns a version string into a tuple that compares in version order.
+    """
+    return tuple(int(part) for part in version.split('.'))
+
+
+def split_sql(script):
+    """
+    Splits an SQL script into its statements.
+    """
+    statement = ''
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+    if statement.strip() and not is_comment(statement):
+        raise sqlite3.ProgrammingError('Incomplete statement: %s' % statement)
+
+
+def is_comment(sql):
+    """
+    Returns whether an SQL fragment holds nothing but comments.
+    """
+    sql = re.sub(r'/\*.*?\*/', '', sql, flags=re.DOTALL)
+    return not re.sub(r'--[^\n]*', '', sql).strip()
+
+
 def get_schema_files(schema_path):
     """
     Returns a list of schema SQL files, sorted by version number.
     """
     files = glob(os.path.join(schema_path, '*.sql'))
-    return natsorted(files)
+    return sorted(files, key=lambda path: parse_version(
+        os.path.basename(path)[:-len('.sql')]))
 
 
 def get_schema_sql(schema_path):
@@ -108,6 +197,29 @@ def get_schema_sql(schema_path):
     return '\n'.join(scripts)
 
 
+def get_storage_stats(conn):
+    """
+    Returns the size of the database file along with the bytes used by each
+    table and index, largest first. Sizes per table and index are only
+    available when SQLite was built with the `dbstat` virtual table.
+    """
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    try:
+        objects = conn.execute("""
+            SELECT dbstat.name, COALESCE(sqlite_master.type, 'internal'),
+                SUM(dbstat.pgsize) AS size
+            FROM dbstat
+            LEFT JOIN sqlite_master ON sqlite_master.name = dbstat.name
+            GROUP BY dbstat.name ORDER BY size DESC
+            """).fetchall()
+    except sqlite3.OperationalError:
+        objects = []
+    return {
+        'size': page_size * page_count,
+        'objects': [tuple(row) for row in objects]}
+
+
 def logger(name='db.general'):
     """
     Log into the internal database logger.
@@ -144,16 +256,29 @@ def get_connection(conn=None):
     """
     Attempts to load a database connection object. If a valid connection object
     is provided explicitly, it is used. If not, an attempt is made to load the
-    connection from the flask global registry.
+    connection from the flask global registry. Requests that set
+    `g.db_readonly` are given a read-only connection.
     """
     if conn:
         return conn
     from flask import g
     if not hasattr(g, 'db'):
-        g.db = get_global_factory().connect()
+        readonly = getattr(g, 'db_readonly', False)
+        g.db = get_global_factory().checkout(readonly=readonly)
     return g.db
 
 
+def release_connection():
+    """
+    Returns the connection loaded by `get_connection` for the current request
+    to the connection pool.
+    """
+    from flask import g
+    if hasattr(g, 'db'):
+        get_global_factory().checkin(g.db)
+        del g.db
+
+
 def get_global_factory():
     """
     Returns the global connection factory. Use `set_global_factory` to set this
@@ -174,33 +299,127 @@ def set_global_factory(factory):
 class Factory(object):
     """
     Database connection factory. Stores database configuration settings and
-    creates new database connections.
+    creates new database connections. Also keeps bounded pools of idle
+    read-write and read-only connections so that requests can reuse
+    connections, along with their prepared statement caches, instead of
+    opening new ones.
     """
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool_size=5, cached_statements=100,
+                 pragmas=None, trace=False):
         self.db_path = db_path
-
-    def connect(self, **options):
+        self.trace = trace
+        self.pool_size = pool_size
+        self.cached_statements = cached_statements
+        self.pragmas = [(k, v) for (k, v) in pragmas or [] if v is not None]
+        self.pools = {False: [], True: []}
+        self.pool_pid = os.getpid()
+        self.pool_lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self, readonly=False, **options):
+        """
+        Opens a new database connection configured with the factory pragmas.
+        A `readonly` connection refuses to write, and in WAL journal mode
+        never waits on a writer.
+        """
         opts = self.default_options()
         opts.update(options)
-        conn = sqlite3.connect(self.db_path, factory=Connection, **opts)
+        factory = TracedConnection if self.trace else Connection
+        conn = sqlite3.connect(self.db_path, factory=factory, **opts)
         conn.row_factory = sqlite3.Row
+        for (name, value) in self.pragmas:
+            if not isinstance(value, (int, long)):
+                value = conn.clean(value)
+            conn.execute('PRAGMA %s=%s' % (conn.clean(name), value)).close()
+        if readonly:
+            conn.execute('PRAGMA query_only=1').close()
+        conn.readonly = readonly
         return conn
 
     def default_options(self):
-        return {'isolation_level': None}
+        return {
+            'isolation_level': None,
+            'cached_statements': self.cached_statements}
+
+    def checkout(self, readonly=False):
+        """
+        Returns an idle connection from the pool, or a new connection if no
+        healthy idle connection is available. Connections that are checked
+        out must be returned with `checkin` once they are no longer used.
+        """
+        while True:
+            with self.pool_lock:
+                self._check_pid()
+                pool = self.pools[readonly]
+                conn = pool.pop() if pool else None
+            if conn is None:
+                break
+            try:
+                conn.execute('SELECT 1').close()
+            except sqlite3.Error:
+                logger().warning('discarding broken pooled connection')
+                continue
+            self.hits += 1
+            return conn
+        self.misses += 1
+        return self.connect(readonly=readonly, check_same_thread=False)
+
+    def checkin(self, conn):
+        """
+        Returns a connection obtained from `checkout` to the pool. Any open
+        transaction is rolled back. The connection is closed instead if the
+        pool is already full.
+        """
+        try:
+            conn.rollback()
+            conn.is_building = False
+            conn.tx_depth = 0
+        except sqlite3.Error:
+            return
+        with self.pool_lock:
+            self._check_pid()
+            pool = self.pools[conn.readonly]
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def pool_stats(self):
+        """
+        Returns pool usage counters. A hit is a checkout served by an idle
+        pooled connection, a miss is one that had to open a new connection.
+        """
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'idle': len(self.pools[False]) + len(self.pools[True]),
+            'size': self.pool_size}
+
+    def _check_pid(self):
+        """
+        Forgets pooled connections inherited from a parent process, since
+        SQLite connections must not be shared across a fork.
+        """
+        if self.pool_pid != os.getpid():
+            self.pools = {False: [], True: []}
+            self.pool_pid = os.getpid()
+            self.hits = 0
+            self.misses = 0
 
 
 class Connection(sqlite3.Connection):
     """
-    Wraps the native database connection object to provide logging ability as
-    well as some helper functions to make querying more concise.
+    Wraps the native database connection object to provide some helper
+    functions to make querying more concise. Statements run straight through
+    the native cursor; see `TracedConnection` for the instrumented version.
     """
 
     def __init__(self, *args, **kwargs):
-        self.ident = self._ident(args[0])
-        self._log('connect %s' % args[0])
+        self.path = args[0]
+        self.readonly = False
         self.is_building = False
+        self.tx_depth = 0
         sqlite3.Connection.__init__(self, *args, **kwargs)
 
     def find(self, table, pk=None, sort=None, order=None, **where):
@@ -294,6 +513,23 @@ class Connection(sqlite3.Connection):
         """
         self.execute('DELETE FROM "%s"' % table)
 
+    def get_key(self, table, pk):
+        """
+        Returns the integer key that other tables use to refer to the record
+        with primary key `pk`, or None if there is no such record.
+        """
+        return self.get_keys(table, [pk]).get(pk)
+
+    def get_keys(self, table, pks):
+        """
+        Returns the integer keys of the records with the given primary keys,
+        as a dict keyed by primary key. Missing records are left out.
+        """
+        pks = list(set(pks))
+        query = 'SELECT "id", "key" FROM "%s" WHERE "id" IN (%s)' % (
+            self.clean(table), ','.join(['?'] * len(pks)))
+        return dict((row[0], row[1]) for row in self.execute(query, pks))
+
     def generate_pk(self, table):
         """
         Returns a new primary key that is guaranteed to be unique. A version 5
@@ -313,6 +549,30 @@ class Connection(sqlite3.Connection):
                 break
         return slug
 
+    @contextmanager
+    def transaction(self, mode='exclusive'):
+        """
+        Runs the enclosed block inside a transaction, committing on success
+        and rolling back on error. The `mode` is the SQLite locking mode used
+        to begin the transaction. Blocks nested inside another transaction, or
+        run while the database is being built, join the transaction that is
+        already open.
+        """
+        outer = not (self.is_building or self.tx_depth)
+        if outer:
+            self.execute('begin %s' % self.clean(mode))
+        self.tx_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.tx_depth -= 1
+            if outer:
+                self.rollback()
+            raise
+        self.tx_depth -= 1
+        if outer:
+            self.commit()
+
     def clean(self, string):
         """
         Enforces a strict naming convention to prevent SQL injection. This
@@ -321,21 +581,6 @@ class Connection(sqlite3.Connection):
         """
         return re.sub(r'[^\w]', '', string)
 
-    def cursor(self, cursorClass=None):
-        return sqlite3.Connection.cursor(self, cursorClass or Cursor)
-
-    def commit(self, *args, **kwargs):
-        self._log('commit')
-        return sqlite3.Connection.commit(self, *args, **kwargs)
-
-    def rollback(self, *args, **kwargs):
-        self._log('rollback')
-        return sqlite3.Connection.rollback(self, *args, **kwargs)
-
-    def close(self, *args, **kwargs):
-        self._log('close')
-        return sqlite3.Connection.close(self, *args, **kwargs)
-
     def paginate(self, cols, sql, params, page, limit):
         offset = (page - 1) * limit
         totals_query = "SELECT COUNT(*) as `count` %s " % sql
@@ -352,53 +597,259 @@ class Connection(sqlite3.Connection):
             'prev_page': None if page is 1 else page - 1,
             'next_page': None if next_page > total_pages else next_page}
 
-    def _ident(self, path):
+    def seek(self, cols, sql, params, keys, limit, token=None, order='desc',
+             count=False):
         """
-        Generates a unique connection ID that will help identify connection
-        patterns in log files.
+        Keyset pagination. Unlike `paginate`, pages are located by seeking to
+        the sort key of the last row seen, so a page costs the same no matter
+        how deep it is. `sql` holds the FROM and WHERE clauses without any
+        ordering, and `keys` the columns that uniquely order its rows, eg:
+        `('match.date_created', 'match.id')`. The returned `next_token` and
+        `prev_token` are opaque strings that are passed back as `token` to
+        fetch the neighbouring pages. The total row count is only computed
+        when `count` is set.
         """
-        tid, pid, rand, ts = (
-            current_thread().ident, os.getpid(), random(), time())
-        ident = '%s_%s_%s_%s_%s' % (tid, pid, rand, ts, path)
-        return sha1(ident).hexdigest()
+        keys = ['.'.join(map(self.clean, k.split('.'))) for k in keys]
+        direction, values = decode_token(token) if token else ('n', None)
+        ascending = (order.lower() == 'asc') == (direction == 'n')
+        query = 'SELECT %s %s' % (cols, sql)
+        seek_params = list(params)
+        if values is not None:
+            if len(values) != len(keys):
+                raise ValueError('Invalid page token')
+            query += ' AND (%s) %s (%s)' % (
+                ', '.join(keys), '>' if ascending else '<',
+                ', '.join('?' * len(keys)))
+            seek_params.extend(values)
+        query += ' ORDER BY %s LIMIT %d' % (
+            ', '.join('%s %s' % (k, 'ASC' if ascending else 'DESC')
+                      for k in keys), limit + 1)
+        result = self.select(query, seek_params)
+        more = len(result) > limit
+        result = result[:limit]
+        if direction == 'p':
+            result.reverse()
+        first, last = (result[0], result[-1]) if result else (None, None)
+        if direction == 'n':
+            has_next, has_prev = more, values is not None
+        else:
+            has_next, has_prev = True, more
+        fields = [k.split('.')[-1] for k in keys]
+        total_rows = None
+        if count:
+            totals_query = 'SELECT COUNT(*) AS `count` %s' % sql
+            total_rows = self.execute(totals_query, params).fetchone()['count']
+        prev_token = next_token = None
+        if has_prev and first:
+            prev_token = encode_token('p', [first[f] for f in fields])
+        if has_next and last:
+            next_token = encode_token('n', [last[f] for f in fields])
+        return {
+            'row_data': result,
+            'total_rows': total_rows,
+            'rows_per_page': limit,
+            'prev_token': prev_token,
+            'next_token': next_token}
+
 
-    def _log(self, message, level='debug'):
-        message = '[%s] %s' % (self.ident, message)
-        getattr(logger('db.query'), level)(message)
+def encode_token(direction, values):
+    """
+    Packs a page direction and the sort key of a row into an opaque page
+    token. See `Connection.seek`.
+    """
+    return urlsafe_b64encode(json.dumps([direction] + values)).rstrip('=')
 
 
-class Cursor(sqlite3.Cursor):
+def decode_token(token):
     """
-    Wraps the native database cursor object to provide logging ability.
+    Unpacks a page token created by `encode_token`. Raises `ValueError` when
+    the token is malformed.
     """
+    try:
+        data = json.loads(urlsafe_b64decode(
+            str(token) + '=' * (-len(token) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('Invalid page token')
+    if not isinstance(data, list) or len(data) < 2:
+        raise ValueError('Invalid page token')
+    if data[0] not in ('n', 'p'):
+        raise ValueError('Invalid page token')
+    for value in data[1:]:
+        if not isinstance(value, (basestring, int, long, float)):
+            raise ValueError('Invalid page token')
+    return data[0], data[1:]
 
-    def execute(self, sql, *args, **kwargs):
-        self._log('execute: %s' % sql)
-        return sqlite3.Cursor.execute(self, sql, *args, **kwargs)
+
+class TracedConnection(Connection):
+    """
+    Connection that records the timing of every statement it runs in the
+    global `query_stats` registry, and logs connection activity into the
+    `db.query` logger.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Connection.__init__(self, *args, **kwargs)
+        self._ident = None
+        self._log('connect %s' % self.path)
+
+    @property
+    def ident(self):
+        """
+        A unique connection ID that will help identify connection patterns in
+        log files.
+        """
+        if self._ident is None:
+            tid, pid, rand, ts = (
+                current_thread().ident, os.getpid(), random(), time())
+            ident = '%s_%s_%s_%s_%s' % (tid, pid, rand, ts, self.path)
+            self._ident = sha1(ident).hexdigest()
+        return self._ident
+
+    def cursor(self, cursorClass=None):
+        return sqlite3.Connection.cursor(self, cursorClass or TracedCursor)
+
+    def commit(self, *args, **kwargs):
+        self._log('commit')
+        return sqlite3.Connection.commit(self, *args, **kwargs)
+
+    def rollback(self, *args, **kwargs):
+        self._log('rollback')
+        return sqlite3.Connection.rollback(self, *args, **kwargs)
+
+    def close(self, *args, **kwargs):
+        self._log('close')
+        return sqlite3.Connection.close(self, *args, **kwargs)
+
+    def _log(self, message, level=logging.DEBUG):
+        log = logger('db.query')
+        if log.isEnabledFor(level):
+            log.log(level, '[%s] %s' % (self.ident, message))
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor that times statement execution and row fetching. Fetch time and
+    rows are added to the statement last executed by the cursor.
+    """
+
+    stat = None
+
+    def execute(self, sql, params=()):
+        return self._trace(sql, params, sqlite3.Cursor.execute, sql, params)
 
     def executemany(self, sql, *args):
-        self._log('executemany: %s' % sql)
-        return sqlite3.Cursor.executemany(self, sql, *args)
+        return self._trace(sql, None, sqlite3.Cursor.executemany, sql, *args)
 
     def executescript(self, sql):
-        self._log('executescript: %s' % sql)
-        return sqlite3.Cursor.executescript(self, sql)
+        return self._trace(sql, None, sqlite3.Cursor.executescript, sql)
 
     def fetchone(self):
-        self._log('fetchone')
-        return sqlite3.Cursor.fetchone(self)
+        return self._fetch(sqlite3.Cursor.fetchone)
 
     def fetchmany(self, *args, **kwargs):
-        self._log('fetchmany')
-        return sqlite3.Cursor.fetchmany(self, *args, **kwargs)
+        return self._fetch(sqlite3.Cursor.fetchmany, *args, **kwargs)
 
     def fetchall(self):
-        self._log('fetchall')
-        return sqlite3.Cursor.fetchall(self)
+        return self._fetch(sqlite3.Cursor.fetchall)
+
+    def _trace(self, sql, params, method, *args):
+        self.connection._log('execute: %s' % sql)
+        started = time()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time() - started
+            self.stat = query_stats.record(sql, elapsed)
+            for listener in statement_listeners:
+                listener(self.connection, sql, params, elapsed)
+
+    def _fetch(self, method, *args, **kwargs):
+        started = time()
+        rows = method(self, *args, **kwargs)
+        if self.stat is not None:
+            count = 0 if rows is None else \
+                (len(rows) if isinstance(rows, list) else 1)
+            query_stats.add_fetch(self.stat, time() - started, count)
+        return rows
+
+
+class QueryStats(object):
+    """
+    In-process registry of statement timings. Statements are grouped by their
+    normalized SQL text, with literal values replaced by placeholders.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stats = {}
+
+    def record(self, sql, elapsed):
+        """
+        Records a single execution of `sql`. Returns the statement's stat
+        entry so that fetch times and rows can be added to it.
+        """
+        key = normalize_sql(sql)
+        with self.lock:
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = {
+                    'sql': key, 'calls': 0, 'total_time': 0.0,
+                    'max_time': 0.0, 'rows': 0}
+            stat['calls'] += 1
+            stat['total_time'] += elapsed
+            stat['max_time'] = max(stat['max_time'], elapsed)
+        return stat
+
+    def add_fetch(self, stat, elapsed, rows):
+        with self.lock:
+            stat['total_time'] += elapsed
+            stat['rows'] += rows
+
+    def dump(self, sort='total_time'):
+        """
+        Returns a copy of all stat entries, most expensive first.
+        """
+        with self.lock:
+            stats = [dict(stat) for stat in self.stats.values()]
+        return sorted(stats, key=lambda stat: stat[sort], reverse=True)
+
+    def find(self, sql):
+        """
+        Returns a copy of the stat entry of the given statement, or None if
+        the statement hasn't run.
+        """
+        with self.lock:
+            stat = self.stats.get(normalize_sql(sql))
+            return None if stat is None else dict(stat)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
 
-    def _log(self, *args, **kwargs):
-        """ Proxy all logs to the connection logger. """
-        self.connection._log(*args, **kwargs)  # pylint: disable=E1101
+    def log(self, limit=20):
+        """
+        Writes the most expensive statements into the `db.stats` logger.
+        """
+        for stat in self.dump()[:limit]:
+            logger('db.stats').info(
+                '%(calls)6d calls %(total_time)9.4fs total %(max_time)8.4fs '
+                'max %(rows)8d rows: %(sql)s' % stat)
+
+query_stats = QueryStats()
+
+# callables run after every traced statement with the connection, the SQL,
+# its parameters (None for scripts and executemany) and the time it took.
+statement_listeners = []
+
+
+def normalize_sql(sql):
+    """
+    Reduces a statement to its shape by collapsing whitespace and replacing
+    literal values and value lists with placeholders.
+    """
+    sql = _sql_literal.sub('?', sql)
+    sql = _sql_list.sub('IN (?)', sql)
+    return ' '.join(sql.split())
 
 
 class Expr(object):
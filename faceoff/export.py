@@ -0,0 +1,63 @@
+"""
+Serializes the match history of a league as CSV or newline delimited JSON.
+The output is produced in chunks while the matches are read, so exports of
+any size can be streamed to a response or a file.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+import csv
+import json
+from cStringIO import StringIO
+from faceoff.models.match import iter_matches
+
+FIELDS = (
+    'id', 'date_created', 'winner_id', 'winner_nickname', 'winner_rank',
+    'winner_mu', 'winner_sigma', 'loser_id', 'loser_nickname', 'loser_rank',
+    'loser_mu', 'loser_sigma', 'draw_prob')
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'}
+
+
+def export_matches(db, league_id, format='csv', chunk_size=1000):
+    """
+    Yields the matches of a league as chunks of CSV or NDJSON text.
+    """
+    chunks = iter_matches(db, league_id, chunk_size=chunk_size)
+    if format == 'csv':
+        return csv_chunks(chunks)
+    elif format == 'ndjson':
+        return ndjson_chunks(chunks)
+    raise ValueError('Unknown export format: %s' % format)
+
+
+def csv_chunks(chunks):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(FIELDS)
+    for rows in chunks:
+        for row in rows:
+            writer.writerow([encode(row[f]) for f in FIELDS])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def ndjson_chunks(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict((f, row[f]) for f in FIELDS),
+                                 separators=(',', ':')) + '\n'
+                      for row in rows)
+
+
+def encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
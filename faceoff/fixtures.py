@@ -12,9 +12,8 @@ from datetime import datetime, timedelta
 from random import shuffle, randint
 from jinja2.utils import generate_lorem_ipsum
 from faceoff.models.user import create_user, get_active_users
-from faceoff.models.league import (
-    create_league, get_all_leagues, get_active_leagues)
-from faceoff.models.match import create_match, rebuild_rankings
+from faceoff.models.league import create_league, get_active_leagues
+from faceoff.models.match import create_match, rebuild_all_rankings
 from faceoff.models.setting import set_setting
 
 _logger = None
@@ -73,9 +72,11 @@ def generate_full_db(db, truncate=False):
     generate_leagues(db, truncate=truncate)
     generate_matches(db, truncate=truncate)
     db.commit()
-    logger().info('rebuilding rankings...')
-    [rebuild_rankings(db, league['id']) for league in get_all_leagues(db)]
     db.is_building = False
+    logger().info('rebuilding rankings...')
+    # fixtures are generated while the app is being imported. a process pool
+    # would deadlock on the import lock, so rankings are rebuilt in-process.
+    rebuild_all_rankings(db, processes=1)
 
 
 def generate_users(db, min_count=4, max_count=12, truncate=False):
@@ -124,6 +125,7 @@ def generate_matches(db, truncate=False):
     """
     if truncate:
         db.truncate_table('match')
+        db.truncate_table('match_participant')
     users = get_active_users(db)
     leagues = get_active_leagues(db)
     for league in leagues:
@@ -3,17 +3,27 @@ Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
 License: MIT, see LICENSE for details
 """
 
-from wtforms import Form, TextField, SelectField, RadioField
+from wtforms import Form, TextField, SelectField, RadioField, FileField
 from wtforms.widgets import PasswordInput
 from wtforms.validators import (
-    Optional, Required, Length, Regexp, EqualTo, AnyOf)
-from faceoff.helpers.validators import UniqueNickname
+    Optional, Required, Length, Regexp, EqualTo, AnyOf, NoneOf)
+from faceoff.helpers.validators import UniqueNickname, ExistingUser
 
 
 class PasswordField(TextField):
     widget = PasswordInput(hide_value=False)
 
 
+class OpponentField(SelectField):
+    """
+    Select field whose choices only list the likeliest opponents. Any other
+    user can be submitted, so the value is checked by validators instead.
+    """
+
+    def pre_validate(self, form):
+        pass
+
+
 class LoginForm(Form):
     nickname = TextField('Nickname', [Required()])
     password = PasswordField('Password', [Required()])
@@ -65,12 +75,23 @@ class JoinForm(Form):
 
 
 class ReportForm(Form):
-    opponent = SelectField('I played against', choices=[])
+    opponent = OpponentField(
+        label='I played against',
+        validators=[Required(), ExistingUser()],
+        choices=[]
+        )
     result = SelectField('and', choices=[('1', 'Won'), ('0', 'Lost')])
 
-    def __init__(self, users, *args, **kwargs):
+    def __init__(self, user_id, *args, **kwargs):
+        """
+        Requires the id of the reporting user, who can't be the opponent.
+        Allow passing an 'opponents' keyword arg with the users to list.
+        """
+        opponents = kwargs.pop('opponents', [])
         super(ReportForm, self).__init__(*args, **kwargs)
-        self.opponent.choices = [(u['id'], u['nickname']) for u in users]
+        self.opponent.choices = [(u['id'], u['nickname']) for u in opponents]
+        validator = NoneOf([user_id], message='you can not play yourself')
+        self.opponent.validators = self.opponent.validators + [validator]
 
 
 class NewLeagueForm(Form):
@@ -110,3 +131,16 @@ class AdminForm(Form):
         id='access_code',
         description='This code is used to create a new Faceoff account.'
         )
+
+
+class ImportForm(Form):
+    league = SelectField('League', choices=[])
+    matches = FileField(
+        label='Matches',
+        validators=[Required()],
+        description='CSV with winner, loser and date columns.'
+        )
+
+    def __init__(self, leagues, *args, **kwargs):
+        super(ImportForm, self).__init__(*args, **kwargs)
+        self.league.choices = [(l['id'], l['name']) for l in leagues]
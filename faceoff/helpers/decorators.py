@@ -3,9 +3,16 @@ Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
 License: MIT, see LICENSE for details
 """
 
+import json
+from hashlib import sha1
+from datetime import date
 from functools import wraps
-from flask import g, request, session, render_template, url_for, redirect
-from faceoff.models.user import find_user
+from flask import (
+    g, request, session, render_template, url_for, redirect, make_response,
+    current_app)
+from werkzeug.http import is_resource_modified
+from faceoff.models.user import get_user_snapshot
+from faceoff.models.league import get_league_version
 
 
 def templated(template_name=None):
@@ -39,9 +46,53 @@ def authenticated(f):
         user_id = session.get('user_id')
         if user_id is None:
             return redirect(url_for('gate'))
-        user = find_user(id=user_id)
+        user = get_user_snapshot(user_id)
         if user is None:
             return redirect(url_for('gate'))
         g.current_user = user
         return f(*args, **kwargs)
     return decorator
+
+
+def readonly(f):
+    """
+    Marks a view as one that never writes to the database. Requests to it are
+    given a read-only connection that doesn't wait on writers.
+    """
+    f.readonly = True
+    return f
+
+
+def conditional(f):
+    """
+    Answers conditional GET requests for a league page with 304 Not Modified
+    when nothing the page shows has changed, before the view does any work.
+    The ETag is derived from `get_league_version`, the current user and the
+    current day, which relative dates are printed against. No Last-Modified
+    is sent, since a date alone can't tell those changes apart. Must be
+    applied after `authenticated`. Pages with pending flash messages are
+    always rendered, since rendering them consumes the messages.
+    """
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+            return f(*args, **kwargs)
+        version = get_league_version(g.current_league['id'])
+        if version is None:
+            return f(*args, **kwargs)
+        etag = sha1(json.dumps([
+            version['date_modified'], version['users'], g.current_user,
+            date.today().isoformat()], sort_keys=True)).hexdigest()
+        if not is_resource_modified(request.environ, etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        # the page depends on who is logged in.
+        response.vary.update(('Cookie', 'Authorization'))
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return decorator
@@ -23,3 +23,19 @@ class UniqueNickname(object):
             if self.message is None:
                 self.message = 'is already in use'
             raise ValidationError(self.message)
+
+
+class ExistingUser(object):
+    """
+    Validates that a value is the id of an existing user.
+    """
+
+    def __init__(self, message=None):
+        self.message = message
+
+    @use_db
+    def __call__(self, db, form, field):
+        if not db.find('user', id=field.data):
+            if self.message is None:
+                self.message = 'is not a user'
+            raise ValidationError(self.message)
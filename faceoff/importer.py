@@ -0,0 +1,192 @@
+"""
+Imports the match history of a league from CSV, such as a spreadsheet export
+or the output of the match export.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+import csv
+from time import time, mktime
+from datetime import datetime
+from logging import getLogger
+from faceoff.cache import bump_version
+from faceoff.models.match import compute_rankings, write_rankings, log_rebuild
+
+# matches inserted per statement
+BATCH_SIZE = 1000
+
+# the first column found of each list is used
+COLUMNS = {
+    'winner': ('winner', 'winner_nickname'),
+    'loser': ('loser', 'loser_nickname'),
+    'date': ('date', 'date_created')}
+
+# a bare date is rejected: matches of the same day would all be played at
+# midnight, and their order against the matches already recorded that day
+# would be lost.
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M')
+
+# at most this many skipped rows are reported by line
+MAX_ERRORS = 50
+
+
+def import_matches(db, league_id, lines, batch_size=BATCH_SIZE,
+                   progress=None):
+    """
+    Imports matches into a league from the CSV `lines`. The first line names
+    the columns, which must include the winner and loser nicknames and the
+    time played, as a timestamp or as YYYY-MM-DD HH:MM with optional seconds.
+    Raises `ValueError` when the file is not valid CSV.
+
+    Every row is parsed before anything is written, so the write lock is
+    only held for the inserts. Matches are then inserted in batches of
+    `batch_size` without updating the rankings, which are rebuilt once at the
+    end starting from the oldest imported match. Every batch and the rebuild
+    run in one transaction, so the league never shows the imported matches
+    without their rankings. `progress` is called with the number of matches
+    imported so far and the rate in rows per second after each batch.
+
+    Rows that can't be imported are skipped. Returns the number of matches
+    imported and skipped, the first `MAX_ERRORS` skipped rows as
+    `(line, message)` pairs, the time taken and the rate in rows per second.
+    """
+    started = time()
+    league_key = db.get_key('league', league_id)
+    if league_key is None:
+        raise ValueError('Unknown league: %s' % league_id)
+    users = dict((row['nickname'], row['key']) for row in db.execute(
+        'SELECT key, nickname FROM user').fetchall())
+    result = {'imported': 0, 'skipped': 0, 'errors': []}
+    matches = read_matches(lines, users, result)
+    if matches:
+        oldest = min(match[2] for match in matches)
+        with db.transaction():
+            for i in xrange(0, len(matches), batch_size):
+                batch = matches[i:i + batch_size]
+                insert_matches(db, league_key, batch)
+                result['imported'] += len(batch)
+                report_progress(progress, result['imported'], started)
+            rankings = compute_rankings(db, league_id, since=oldest)
+            write_rankings(db, rankings)
+            bump_version('league', league_id, db=db)
+        log_rebuild(rankings)
+    result['elapsed'] = time() - started
+    result['rate'] = result['imported'] / max(result['elapsed'], 0.001)
+    logger().info('imported %d matches into league %s in %.2fs' % (
+        result['imported'], league_id, result['elapsed']))
+    return result
+
+
+def read_matches(lines, users, result):
+    """
+    Parses the CSV `lines` into `(winner_key, loser_key, date_created)`
+    matches. Rows that can't be imported are counted as skipped in `result`.
+    """
+    reader = csv.reader(lines)
+    matches = []
+    try:
+        columns = find_columns(next(reader, []))
+        for row in reader:
+            if not any(row):
+                continue
+            try:
+                matches.append(parse_row(row, columns, users))
+            except ValueError as e:
+                result['skipped'] += 1
+                if len(result['errors']) < MAX_ERRORS:
+                    result['errors'].append((reader.line_num, str(e)))
+    except csv.Error as e:
+        raise ValueError('line %d: %s' % (reader.line_num, e))
+    return matches
+
+
+def insert_matches(db, league_key, batch):
+    """
+    Inserts `(winner_key, loser_key, date_created)` matches and their
+    participants. Match keys are assigned in increasing order, so the
+    participants of the batch are copied from every match with a key above
+    the largest one before the batch. Must run inside a transaction.
+    """
+    last = db.execute(
+        'SELECT COALESCE(MAX(key), 0) AS last FROM match').fetchone()
+    db.executemany("""
+        INSERT INTO match (id, league_key, winner_key, loser_key,
+            date_created)
+        VALUES (?, ?, ?, ?, ?)
+        """, [(db.generate_pk('match'), league_key, winner, loser, date)
+              for (winner, loser, date) in batch])
+    db.execute("""
+        INSERT INTO match_participant
+            (league_key, user_key, date_created, match_key, result)
+        SELECT league_key, winner_key, date_created, key, 1 FROM match
+        WHERE key > ?
+        """, [last['last']])
+    db.execute("""
+        INSERT INTO match_participant
+            (league_key, user_key, date_created, match_key, result)
+        SELECT league_key, loser_key, date_created, key, 0 FROM match
+        WHERE key > ?
+        """, [last['last']])
+
+
+def find_columns(header):
+    """
+    Returns the index of the winner, loser and date columns in the CSV
+    header.
+    """
+    header = [name.strip().lower() for name in header]
+    columns = {}
+    for (column, names) in COLUMNS.iteritems():
+        found = [header.index(name) for name in names if name in header]
+        if not found:
+            raise ValueError('Missing %s column' % column)
+        columns[column] = found[0]
+    return columns
+
+
+def parse_row(row, columns, users):
+    """
+    Returns the `(winner_key, loser_key, date_created)` of a CSV row.
+    """
+    try:
+        (winner, loser, date) = [row[columns[c]].strip().decode('utf-8')
+                                 for c in ('winner', 'loser', 'date')]
+    except IndexError:
+        raise ValueError('missing columns')
+    for nickname in (winner, loser):
+        if nickname not in users:
+            raise ValueError('unknown user: %s' % nickname.encode('utf-8'))
+    if winner == loser:
+        raise ValueError(
+            '%s can not play themselves' % winner.encode('utf-8'))
+    return (users[winner], users[loser], parse_date(date))
+
+
+def parse_date(value):
+    """
+    Turns a timestamp or a local date and time of day into a timestamp.
+    """
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return int(mktime(
+                datetime.strptime(value, date_format).timetuple()))
+        except ValueError:
+            pass
+    raise ValueError('invalid date: %s' % value.encode('utf-8'))
+
+
+def report_progress(progress, imported, started):
+    if progress is not None:
+        progress(imported, imported / max(time() - started, 0.001))
+
+
+def logger():
+    """
+    Returns the importer logger.
+    """
+    return getLogger('importer')
@@ -0,0 +1,63 @@
+"""
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+from time import time
+from faceoff.db import use_db
+
+# seconds between two checks of the stored generation of a snapshot. changes
+# made in other processes show up after at most this long.
+CHECK_INTERVAL = 1
+
+
+@use_db
+def get_generation(db, name):
+    row = db.execute(
+        'SELECT value FROM generation WHERE name=?', [name]).fetchone()
+    return 0 if row is None else row['value']
+
+
+@use_db
+def bump_generation(db, name):
+    db.execute("""
+        INSERT INTO generation (name, value) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET value=value+1
+        """, [name])
+
+
+class Snapshot(object):
+    """
+    In-process copy of data that rarely changes, such as the list of leagues.
+    The data is loaded by `loader` on first use and reloaded once the
+    generation called `name` moves. Changes made by this process are seen
+    immediately, and changes made by other processes once the stored
+    generation is checked again, which happens at most once every
+    `CHECK_INTERVAL` seconds.
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.state = None
+        self.checked = 0
+
+    def get(self, db=None):
+        state = self.state
+        now = time()
+        if state is None or now - self.checked >= CHECK_INTERVAL:
+            generation = get_generation(self.name, db=db)
+            if state is None or state[0] != generation:
+                # the generation is read before loading, so that a change
+                # made while loading is picked up by the next check.
+                state = self.state = (generation, self.loader(db=db))
+            self.checked = now
+        return state[1]
+
+    def invalidate(self, db=None):
+        """
+        Bumps the generation after the data was changed, making every process
+        reload it.
+        """
+        bump_generation(self.name, db=db)
+        self.state = None
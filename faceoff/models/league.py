@@ -6,6 +6,8 @@ License: MIT, see LICENSE for details
 import re
 from time import time
 from faceoff.db import use_db
+from faceoff.cache import bump_version
+from faceoff.models.generation import Snapshot
 
 
 @use_db
@@ -13,6 +15,16 @@ def find_league(db, **kwargs):
     return db.find('league', **kwargs)
 
 
+def get_league_by_slug(slug, db=None):
+    """
+    Returns the league at `slug`. Every league page looks its league up by
+    slug, so this is a lookup in an in-memory index of all leagues, and no
+    connection is used unless the index has to be checked or reloaded.
+    """
+    league = league_index.get(db).get(slug)
+    return None if league is None else dict(league)
+
+
 @use_db
 def search_leagues(db, **kwargs):
     return db.search('league', **kwargs)
@@ -36,13 +48,17 @@ def get_inactive_leagues(db):
 @use_db
 def create_league(db, name, description=None, active=True):
     name = name.strip()
-    return db.insert(
+    slug = generate_league_slug(db, name)
+    league_id = db.insert(
         'league',
         name=name,
-        slug=generate_league_slug(db, name),
+        slug=slug,
         description=description,
         active='1' if active else '0',
-        date_created=int(time()))
+        date_created=int(time()),
+        date_modified=time())
+    league_index.invalidate(db)
+    return league_id
 
 
 @use_db
@@ -59,10 +75,40 @@ def update_league(db, league_id, name=None, active=None):
         fields['slug'] = slug
     if active is not None:
         fields['active'] = '1' if active else '0'
-    db.update('league', league_id, **fields)
+    fields['date_modified'] = time()
+    with db.transaction():
+        db.update('league', league_id, **fields)
+        bump_version('league', league_id, db=db)
+        league_index.invalidate(db)
     return find_league(db, id=league_id)
 
 
+@use_db
+def touch_league(db, league_key):
+    """
+    Records that the matches or rankings of a league changed. Takes the
+    league key.
+    """
+    db.execute('UPDATE league SET date_modified=? WHERE key=?',
+               [time(), league_key])
+
+
+@use_db
+def get_league_version(db, league_id):
+    """
+    Returns when a league last changed, along with the generation of the
+    user list, which together identify the state of the league's pages.
+    Reads both from primary key indexes in a single query.
+    """
+    rows = db.select("""
+        SELECT league.date_modified,
+            (SELECT value FROM generation WHERE name='users') AS users
+        FROM league
+        WHERE league.id=?
+        """, [league_id])
+    return rows[0] if rows else None
+
+
 @use_db
 def generate_league_slug(db, name):
     short = re.sub(r'[^0-9a-zA-Z]+', '-', name.lower()).strip('-')
@@ -73,3 +119,10 @@ def generate_league_slug(db, name):
             break
         count += 1
     return slug
+
+
+@use_db
+def load_league_index(db):
+    return dict((league['slug'], league) for league in get_all_leagues(db))
+
+league_index = Snapshot('league', load_league_index)
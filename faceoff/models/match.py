@@ -5,8 +5,17 @@ License: MIT, see LICENSE for details
 
 from time import time
 from datetime import datetime
-from faceoff.db import use_db
+from logging import getLogger
+from multiprocessing import Pool
+from faceoff.db import use_db, Factory
+from faceoff.cache import cached, bump_version
+from faceoff.models.league import get_all_leagues, touch_league
+from faceoff.models.user import get_active_users
 from trueskill import TrueSkill
+from faceoff.rating import WinLossKernel
+
+# number of matches replayed between two ranking checkpoints
+CHECKPOINT_INTERVAL = 500
 
 
 @use_db
@@ -14,30 +23,64 @@ def find_match(db, **kwargs):
     return db.find('match', **kwargs)
 
 
+@cached('search_matches', namespace='league')
 @use_db
 def search_matches(db, league_id, user_id=None, time_start=None, time_end=None,
-                   page=None, per_page=10, sort='date_created', order='desc'):
+                   page=None, per_page=10, sort='date_created', order='desc',
+                   seek=False, token=None, count=False):
+    """
+    Returns the matches of a league, optionally only those of one user within
+    a time range. Passing `page` paginates by offset. Passing `seek` or a page
+    `token` paginates by keyset instead, which always orders by date and only
+    counts the total number of matches when `count` is set.
+    """
     params = [league_id]
     fields = """
-        match.*, winner.id AS winner_id, winner.nickname AS winner_nickname,
+        match.*, league.id AS league_id,
+        winner.id AS winner_id, winner.nickname AS winner_nickname,
         loser.id AS loser_id, loser.nickname AS loser_nickname
         """
-    query = """
-        FROM match
-        INNER JOIN user AS winner ON winner.id = match.winner_id
-        INNER JOIN user AS loser ON loser.id = match.loser_id
-        WHERE match.league_id=?
-        """
-    if user_id is not None:
-        query += " AND (winner.id=? OR loser.id=?) "
-        params.extend([user_id, user_id])
+    if user_id is None:
+        source = 'match'
+        keys = ('match.date_created', 'match.key')
+        query = """
+            FROM league
+            INNER JOIN match ON match.league_key = league.key
+            INNER JOIN user AS winner ON winner.key = match.winner_key
+            INNER JOIN user AS loser ON loser.key = match.loser_key
+            WHERE league.id=?
+            """
+    else:
+        # a player's matches are read through match_participant, which is
+        # indexed by player and date, and only then joined to the match.
+        source = 'participant'
+        keys = ('participant.date_created', 'participant.match_key')
+        fields += ', participant.match_key'
+        query = """
+            FROM league
+            INNER JOIN user AS player
+            INNER JOIN match_participant AS participant
+                ON participant.league_key = league.key
+                AND participant.user_key = player.key
+            INNER JOIN match ON match.key = participant.match_key
+            INNER JOIN user AS winner ON winner.key = match.winner_key
+            INNER JOIN user AS loser ON loser.key = match.loser_key
+            WHERE league.id=? AND player.id=?
+            """
+        params.append(user_id)
     if time_start is not None:
-        query += " AND match.date_created >= ? "
+        query += " AND %s.date_created >= ? " % source
         params.append(time_start)
     if time_end is not None:
-        query += " AND match.date_created <= ? "
+        query += " AND %s.date_created <= ? " % source
         params.append(time_end)
-    query += ' ORDER BY match.%s %s ' % (db.clean(sort), db.clean(order))
+    if seek or token is not None:
+        return db.seek(fields, query, params, keys, per_page, token=token,
+                       order=order, count=count)
+    sort = db.clean(sort)
+    if sort != 'date_created':
+        source = 'match'
+    query += ' ORDER BY %s.%s %s ' % (source, sort, db.clean(order))
     if page is not None and page > 0:
         return db.paginate(fields, query, params, page, per_page)
     else:
@@ -47,8 +90,8 @@ def search_matches(db, league_id, user_id=None, time_start=None, time_end=None,
 @use_db
 def find_older_match(db, league_id, user_id, timestamp):
     result = search_matches(
-        db, league_id, user_id=user_id, time_end=timestamp, page=1, per_page=1
-        )
+        db, league_id, user_id=user_id, time_end=timestamp, seek=True,
+        per_page=1)
     if not len(result['row_data']):
         return None
     match = result['row_data'][0]
@@ -64,7 +107,7 @@ def find_older_match(db, league_id, user_id, timestamp):
 @use_db
 def find_newer_match(db, league_id, user_id, timestamp):
     result = search_matches(
-        db, league_id, user_id=user_id, time_start=timestamp, page=1,
+        db, league_id, user_id=user_id, time_start=timestamp, seek=True,
         per_page=1, order='asc')
     if not len(result['row_data']):
         return None
@@ -78,103 +121,588 @@ def find_newer_match(db, league_id, user_id, timestamp):
     return match
 
 
+@use_db
+def iter_matches(db, league_id, chunk_size=1000):
+    """
+    Yields every match of a league, oldest first, in lists of at most
+    `chunk_size` matches. Matches are read from the cursor as the lists are
+    consumed, so memory use doesn't grow with the size of the league.
+    """
+    cursor = db.execute("""
+        SELECT match.id, match.date_created,
+            winner.id AS winner_id, winner.nickname AS winner_nickname,
+            match.winner_rank, match.winner_mu, match.winner_sigma,
+            loser.id AS loser_id, loser.nickname AS loser_nickname,
+            match.loser_rank, match.loser_mu, match.loser_sigma,
+            match.draw_prob
+        FROM league
+        INNER JOIN match ON match.league_key = league.key
+        INNER JOIN user AS winner ON winner.key = match.winner_key
+        INNER JOIN user AS loser ON loser.key = match.loser_key
+        WHERE league.id=?
+        ORDER BY match.date_created ASC, match.key ASC
+        """, [league_id])
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(zip(row.keys(), row)) for row in rows]
+    finally:
+        cursor.close()
+
+
 @use_db
 def create_match(db, league_id, winner_user_id, loser_user_id, match_date=None,
                  norebuild=False):
-    match_id = db.insert(
-        'match',
-        league_id=league_id,
-        winner_id=winner_user_id,
-        winner_rank=get_user_rank(db, league_id, winner_user_id),
-        loser_id=loser_user_id,
-        loser_rank=get_user_rank(db, league_id, loser_user_id),
-        date_created=int(time()) if match_date is None else match_date)
-    if not norebuild:
-        rebuild_rankings(db, league_id)
-    return match_id
+    matches = [(league_id, winner_user_id, loser_user_id, match_date)]
+    return create_matches(db, matches, norebuild=norebuild)[0]
+
+
+@use_db
+def create_matches(db, matches, norebuild=False):
+    """
+    Records several matches in a single transaction. `matches` is a list of
+    `(league_id, winner_user_id, loser_user_id, match_date)` tuples. The
+    rankings of each league involved are updated once, after all of its
+    matches were recorded. Returns the new match ids in the same order.
+    """
+    leagues = {}
+    order = []
+    for (i, (league_id, winner, loser, match_date)) in enumerate(matches):
+        date_created = int(time()) if match_date is None else match_date
+        if league_id not in leagues:
+            leagues[league_id] = []
+            order.append(league_id)
+        leagues[league_id].append((i, winner, loser, date_created))
+    match_ids = [None] * len(matches)
+    with db.transaction():
+        for league_id in order:
+            results = record_matches(db, league_id, leagues[league_id],
+                                     norebuild)
+            for (i, match_id) in results:
+                match_ids[i] = match_id
+        bump_version('league', *order, db=db)
+    return match_ids
 
 
+@use_db
+def record_matches(db, league_id, matches, norebuild=False):
+    """
+    Inserts `(index, winner_user_id, loser_user_id, date_created)` matches
+    into a league and updates its rankings. Returns `(index, match_id)`
+    pairs.
+    """
+    league_key = db.get_key('league', league_id)
+    user_keys = db.get_keys('user', [m[1] for m in matches] +
+                            [m[2] for m in matches])
+    if league_key is None:
+        raise ValueError('Unknown league: %s' % league_id)
+    for (i, winner, loser, date_created) in matches:
+        for user_id in (winner, loser):
+            if user_id not in user_keys:
+                raise ValueError('Unknown user: %s' % user_id)
+
+    # matches played one after another, after every other match in the
+    # league, only change the players involved, so their rankings can be
+    # updated in place. anything older has to be replayed with the rest of
+    # the history.
+    dates = [m[3] for m in matches]
+    backdated = is_backdated(db, league_key, dates[0]) or \
+        any(later <= earlier for (earlier, later) in zip(dates, dates[1:]))
+    kernel = WinLossKernel(TrueSkill())
+    (players, ranks) = load_rankings(db, kernel, league_key)
+    if players is None:
+        # rankings built before ratings were stored can't be updated in
+        # place, so fall back to replaying the league.
+        backdated = True
+    stored = dict(ranks)
+    results = []
+    for (i, winner_id, loser_id, date_created) in matches:
+        (winner, loser) = (user_keys[winner_id], user_keys[loser_id])
+        match_id = db.generate_pk('match')
+        cursor = db.execute("""
+            INSERT INTO match (
+                id, league_key, winner_key, winner_rank, loser_key,
+                loser_rank, date_created)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [match_id, league_key, winner, ranks.get(winner), loser,
+                  ranks.get(loser), date_created])
+        insert_participants(db, league_key, cursor.lastrowid, winner, loser,
+                            date_created)
+        results.append((i, match_id))
+        if not (norebuild or backdated):
+            apply_match(kernel, players, winner, loser)
+            ranks = dict((p['id'], rank+1) for (rank, p) in
+                         enumerate(sort_players(kernel, players)))
+    if norebuild:
+        pass
+    elif backdated:
+        rebuild_rankings(db, league_id, since=min(dates))
+    else:
+        changed = set(user_keys.values())
+        update_rankings(db, league_key, players, ranks, stored, changed)
+        checkpoint_rankings(db, league_key, dates[-1])
+    touch_league(db, league_key)
+    return results
+
+
+@use_db
+def insert_participants(db, league_key, match_key, winner, loser,
+                        date_created):
+    """
+    Records both sides of a match in `match_participant`. The players are
+    given by user key.
+    """
+    sides = [(winner, 1)] if winner == loser else [(winner, 1), (loser, 0)]
+    for (user_key, result) in sides:
+        db.insert('match_participant', pk=False, league_key=league_key,
+                  user_key=user_key, date_created=date_created,
+                  match_key=match_key, result=result)
+
+
+@use_db
+def is_backdated(db, league_key, date_created):
+    """
+    Returns True if a match played at `date_created` can't simply be appended
+    to the end of the league history. A checkpoint covers every match played
+    up to its second, so a match played in the same second as the newest one
+    counts as backdated too, to keep any checkpoint taken at that second
+    consistent.
+    """
+    newest = db.execute(
+        'SELECT MAX(date_created) AS newest FROM match WHERE league_key=?',
+        [league_key]).fetchone()['newest']
+    return newest is not None and date_created <= newest
+
+
+@cached('get_league_ranking', namespace='league')
 @use_db
 def get_league_ranking(db, league_id):
     return db.select("""
-        SELECT ranking.*, user.nickname
-        FROM ranking
-        INNER JOIN user ON user.id=ranking.user_id
-        WHERE ranking.league_id=?
+        SELECT ranking.*, league.id AS league_id, user.id AS user_id,
+            user.nickname
+        FROM league
+        INNER JOIN ranking ON ranking.league_key=league.key
+        INNER JOIN user ON user.key=ranking.user_key
+        WHERE league.id=?
         ORDER BY ranking.rank ASC
         """, [league_id])
 
 
+@cached('get_recent_opponents', namespace='league')
+@use_db
+def get_recent_opponents(db, league_id, user_id, limit=10):
+    """
+    Returns the users that a user has most recently played in a league, most
+    recent first.
+    """
+    return db.select("""
+        SELECT opponent.id, opponent.nickname,
+            MAX(participant.date_created) AS last_played
+        FROM league
+        INNER JOIN user AS player
+        INNER JOIN match_participant AS participant
+            ON participant.league_key = league.key
+            AND participant.user_key = player.key
+        INNER JOIN match ON match.key = participant.match_key
+        INNER JOIN user AS opponent ON opponent.key = CASE participant.result
+            WHEN 1 THEN match.loser_key ELSE match.winner_key END
+        WHERE league.id=? AND player.id=? AND opponent.key != player.key
+        GROUP BY opponent.key
+        ORDER BY last_played DESC
+        LIMIT ?
+        """, [league_id, user_id, limit])
+
+
+@use_db
+def get_opponents(db, league_id, user_id, limit, recent=10):
+    """
+    Returns the users that a user is likely to report a match against, for
+    the match report form. Recent opponents come first, then the rest of the
+    league in ranking order and then everyone else in nickname order. At most
+    `limit` users are returned, leaving the rest to be searched by nickname.
+    """
+    opponents = []
+    seen = set([user_id])
+    sources = (
+        lambda: get_recent_opponents(db, league_id, user_id, recent),
+        lambda: get_league_ranking(db, league_id),
+        lambda: get_active_users(db, limit=limit + len(seen)))
+    for source in sources:
+        for user in source():
+            opponent_id = user['user_id'] if 'user_id' in user else user['id']
+            if opponent_id in seen:
+                continue
+            seen.add(opponent_id)
+            opponents.append(dict(id=opponent_id, nickname=user['nickname']))
+            if len(opponents) == limit:
+                return opponents
+    return opponents
+
+
 @use_db
 def get_user_rank(db, league_id, user_id):
-    rank = db.find('ranking', league_id=league_id, user_id=user_id)
+    rank = get_user_standing(db, league_id, user_id)
     return None if rank is None else rank['rank']
 
 
+@cached('get_user_standing', namespace='league')
 @use_db
 def get_user_standing(db, league_id, user_id):
-    return db.find('ranking', league_id=league_id, user_id=user_id)
+    rows = db.select("""
+        SELECT ranking.*, league.id AS league_id, user.id AS user_id
+        FROM league
+        INNER JOIN user
+        INNER JOIN ranking
+            ON ranking.league_key=league.key AND ranking.user_key=user.key
+        WHERE league.id=? AND user.id=?
+        """, [league_id, user_id])
+    return rows[0] if rows else None
 
 
 @use_db
-def rebuild_rankings(db, league_id):
+def rebuild_rankings(db, league_id, since=None):
+    """
+    Replays the league match history to rebuild the rankings. By default all
+    matches are replayed. If `since` is given, only matches played at or
+    after that time have changed, so the nearest earlier checkpoint is
+    restored and only the matches after it are replayed.
+    """
     # exclusive lock is needed to prevent race conditions when multiple people
     # are simultaneously reporting a match.
-    if not db.is_building:
-        db.execute('begin exclusive')
+    with db.transaction():
+        result = compute_rankings(db, league_id, since)
+        write_rankings(db, result)
+        bump_version('league', league_id, db=db)
+    log_rebuild(result)
+
+
+@use_db
+def rebuild_all_rankings(db, processes=None):
+    """
+    Rebuilds the rankings of every league. Leagues are independent, so their
+    rankings are computed in a pool of `processes` worker processes (one per
+    CPU by default) and then written back in a single transaction.
+    """
+    # the immediate lock keeps other writers out while the workers read, so
+    # every league is computed from the same snapshot that is overwritten.
+    with db.transaction('immediate'):
+        jobs = [(db.path, league['id']) for league in get_all_leagues(db)]
+        if processes == 1 or len(jobs) < 2:
+            results = map(rebuild_worker, jobs)
+        else:
+            pool = Pool(processes)
+            try:
+                results = pool.map(rebuild_worker, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        [write_rankings(db, result) for result in results]
+        bump_version('league', *[result['league_id'] for result in results],
+                     db=db)
+    [log_rebuild(result) for result in results]
+    return len(results)
+
+
+def rebuild_worker(job):
+    """
+    Computes the rankings of a single league in a worker process. Each worker
+    reads through its own database connection.
+    """
+    (db_path, league_id) = job
+    db = Factory(db_path).connect()
+    try:
+        return compute_rankings(db, league_id)
+    finally:
+        db.close()
+
+
+@use_db
+def compute_rankings(db, league_id, since=None):
+    """
+    Replays league matches without writing anything. Returns the new ranking
+    and checkpoint records along with timings, to be saved with
+    `write_rankings`. See `rebuild_rankings` for the meaning of `since`.
+    """
+    kernel = WinLossKernel(TrueSkill())
+    league_key = db.get_key('league', league_id)
+
+    # generate a local player ranking profile based on user key. all matches
+    # after the checkpoint will be traversed in the order they were played
+    # and this object will be populated to build the rankings. the sort order
+    # matches idx_match_league_replay so matches are read straight from the
+    # covering index.
+    started = time()
+    if since is None:
+        restored, players = None, {}
+    else:
+        restored, players = restore_checkpoint(db, kernel, league_key, since)
+    query = """
+        SELECT winner_key, loser_key, date_created FROM match
+        WHERE league_key=? AND date_created > ?
+        ORDER BY date_created, key
+        """
+    params = [league_key, -1 if restored is None else restored]
+    matches = db.execute(query, params).fetchall()
+    read_time = time() - started
 
-    # delete all existing rankings
-    db.execute('DELETE FROM ranking WHERE league_id=?', [league_id])
+    # a checkpoint is only taken between matches played at different times,
+    # so that it covers every match up to its date.
+    started = time()
+    checkpoints = []
+    cutoff = restored
+    replayed = 0
+    for (winner_key, loser_key, date_created) in matches:
+        if replayed >= CHECKPOINT_INTERVAL and date_created > cutoff:
+            checkpoints.extend(checkpoint_rows(league_key, cutoff, players))
+            replayed = 0
+        apply_match(kernel, players, winner_key, loser_key)
+        cutoff = date_created
+        replayed += 1
+    rankings = [ranking_fields(league_key, i+1, p)
+                for (i, p) in enumerate(sort_players(kernel, players))]
+    rate_time = time() - started
 
-    skill = TrueSkill()
+    return {
+        'league_id': league_id, 'league_key': league_key,
+        'restored': restored, 'rankings': rankings,
+        'checkpoints': checkpoints, 'matches': len(matches),
+        'read_time': read_time, 'rate_time': rate_time}
 
-    # generate a local player ranking profile based on user id. all matches
-    # will be traversed and this object will be populated to build the
-    # rankings.
+
+@use_db
+def write_rankings(db, result):
+    """
+    Replaces the league rankings, and the checkpoints after the one that was
+    restored, with the records computed by `compute_rankings`.
+    """
+    started = time()
+    league_key = result['league_key']
+    if result['restored'] is None:
+        db.execute(
+            'DELETE FROM ranking_checkpoint WHERE league_key=?', [league_key])
+    else:
+        db.execute("""
+            DELETE FROM ranking_checkpoint
+            WHERE league_key=? AND date_created > ?
+            """, [league_key, result['restored']])
+    save_checkpoints(db, result['checkpoints'])
+    db.execute('DELETE FROM ranking WHERE league_key=?', [league_key])
+    db.executemany("""
+        INSERT INTO ranking (
+            league_key, user_key, rank, mu, sigma, wins, losses, win_streak,
+            loss_streak, games)
+        VALUES (
+            :league_key, :user_key, :rank, :mu, :sigma, :wins, :losses,
+            :win_streak, :loss_streak, :games)
+        """, result['rankings'])
+    touch_league(db, league_key)
+    result['write_time'] = time() - started
+
+
+def log_rebuild(result):
+    logger().info(
+        'rebuilt league %s: %d matches, %d players, read %.3fs, rate %.3fs, '
+        'write %.3fs' % (
+            result['league_id'], result['matches'], len(result['rankings']),
+            result['read_time'], result['rate_time'], result['write_time']))
+
+
+@use_db
+def get_checkpoint_cutoff(db, league_key, before=None):
+    """
+    Returns the time covered by the newest league checkpoint, optionally only
+    considering checkpoints older than `before`. Returns None if there is no
+    such checkpoint.
+    """
+    query = """
+        SELECT MAX(date_created) AS cutoff FROM ranking_checkpoint
+        WHERE league_key=?
+        """
+    params = [league_key]
+    if before is not None:
+        query += ' AND date_created < ? '
+        params.append(before)
+    return db.execute(query, params).fetchone()['cutoff']
+
+
+@use_db
+def restore_checkpoint(db, kernel, league_key, before):
+    """
+    Loads the newest league checkpoint older than `before`. Returns a tuple of
+    the checkpoint time and the ranking profiles, or `(None, {})` if there is
+    no such checkpoint.
+    """
+    cutoff = get_checkpoint_cutoff(db, league_key, before)
+    if cutoff is None:
+        return None, {}
+    rows = db.search('ranking_checkpoint', league_key=league_key,
+                     date_created=cutoff)
+    return cutoff, dict(
+        (row['user_key'], player_from_ranking(kernel, row)) for row in rows)
+
+
+@use_db
+def save_checkpoints(db, rows):
+    """
+    Stores checkpoint records built with `checkpoint_rows`.
+    """
+    db.executemany("""
+        INSERT INTO ranking_checkpoint (
+            league_key, date_created, user_key, mu, sigma, wins, losses,
+            win_streak, loss_streak, games)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+
+def checkpoint_rows(league_key, cutoff, players):
+    """
+    Returns checkpoint records holding the ranking profiles of all players
+    after every league match played up to `cutoff`.
+    """
+    rows = []
+    for p in players.values():
+        rows.append((
+            league_key, cutoff, p['id'], p['rating'].mu,
+            p['rating'].sigma, p['win'], p['loss'], p['win_streak'],
+            p['loss_streak'], p['games']))
+    return rows
+
+
+@use_db
+def checkpoint_rankings(db, league_key, date_created):
+    """
+    Copies the current league rankings into a new checkpoint once enough
+    matches have been played since the last one. Must only be called right
+    after a match played at `date_created` was applied with `update_rankings`.
+    """
+    cutoff = get_checkpoint_cutoff(db, league_key)
+    query = 'SELECT COUNT(*) AS count FROM match WHERE league_key=? '
+    params = [league_key]
+    if cutoff is not None:
+        query += ' AND date_created > ? '
+        params.append(cutoff)
+    if db.execute(query, params).fetchone()['count'] < CHECKPOINT_INTERVAL:
+        return
+    db.execute("""
+        INSERT INTO ranking_checkpoint (
+            league_key, date_created, user_key, mu, sigma, wins, losses,
+            win_streak, loss_streak, games)
+        SELECT league_key, ?, user_key, mu, sigma, wins, losses, win_streak,
+            loss_streak, games
+        FROM ranking WHERE league_key=?
+        """, [date_created, league_key])
+
+
+@use_db
+def load_rankings(db, kernel, league_key):
+    """
+    Loads the stored league rankings. Returns a tuple of ranking profiles
+    and ranks, both keyed by user key. The profiles are None if any ranking
+    was stored without a rating.
+    """
     players = {}
-    for match in db.search('match', league_id=league_id):
-        w = match['winner_id']
-        l = match['loser_id']
-
-        # create ranking profile if hasn't been added yet
-        for p in [w, l]:
-            if not p in players:
-                players[p] = {
-                    'id': p, 'win': 0, 'loss': 0, 'win_streak': 0,
-                    'loss_streak': 0, 'games': 0, 'rating': skill.Rating()}
-
-        # define ranking profile properties, this will go into the db and will
-        # be viewable on the standings page
-        players[w]['games'] += 1
-        players[w]['win'] += 1
-        players[w]['win_streak'] += 1
-        players[w]['loss_streak'] = 0
-        players[l]['games'] += 1
-        players[l]['loss'] += 1
-        players[l]['win_streak'] = 0
-        players[l]['loss_streak'] += 1
-
-        # finally, record the match with trueskill and let it calculate ranks
-        wr = players[w]['rating']
-        lr = players[l]['rating']
-        (wr, lr) = skill.transform_ratings([(wr,), (lr,)])
-        players[w]['rating'] = wr[0]
-        players[l]['rating'] = lr[0]
-
-    # sort the players based on their ranking
-    rankings = [p for p in players.values()]
-    rankings.sort(key=lambda p: p['rating'].exposure)
-    rankings.reverse()
-
-    # create rankings
-    for (i, r) in enumerate(rankings):
-        fields = {
-            'league_id': league_id, 'user_id': r['id'], 'rank': (i+1),
-            'mu': r['rating'].mu, 'sigma': r['rating'].sigma, 'wins': r['win'],
-            'losses': r['loss'], 'win_streak': r['win_streak'],
-            'loss_streak': r['loss_streak'], 'games': r['games']
-            }
-        db.insert('ranking', pk=False, **fields)
-
-    if not db.is_building:
-        db.commit()
+    ranks = {}
+    for row in db.search('ranking', league_key=league_key):
+        ranks[row['user_key']] = row['rank']
+        if players is None or row['mu'] is None or row['sigma'] is None:
+            players = None
+        else:
+            players[row['user_key']] = player_from_ranking(kernel, row)
+    return players, ranks
+
+
+@use_db
+def update_rankings(db, league_key, players, ranks, stored, changed):
+    """
+    Saves ranking profiles that were updated in place. Only the rows that
+    changed are rewritten: the `changed` players that played and everyone
+    whose rank moved from the `stored` rank as a result.
+    """
+    for (user_key, rank) in ranks.iteritems():
+        if user_key not in changed and stored.get(user_key) == rank:
+            continue
+        fields = ranking_fields(league_key, rank, players[user_key])
+        if user_key in stored:
+            db.execute("""
+                UPDATE ranking SET rank=?, mu=?, sigma=?, wins=?, losses=?,
+                    win_streak=?, loss_streak=?, games=?
+                WHERE league_key=? AND user_key=?
+                """, [fields['rank'], fields['mu'], fields['sigma'],
+                      fields['wins'], fields['losses'], fields['win_streak'],
+                      fields['loss_streak'], fields['games'], league_key,
+                      user_key])
+        else:
+            db.insert('ranking', pk=False, **fields)
+
+
+def apply_match(kernel, players, winner_user_key, loser_user_key):
+    """
+    Records the outcome of a single match in the `players` ranking profiles,
+    creating profiles for players that haven't been seen yet.
+    """
+    w = winner_user_key
+    l = loser_user_key
+
+    # create ranking profile if hasn't been added yet
+    for p in [w, l]:
+        if p not in players:
+            players[p] = {
+                'id': p, 'win': 0, 'loss': 0, 'win_streak': 0,
+                'loss_streak': 0, 'games': 0,
+                'rating': kernel.create_rating()}
+
+    # define ranking profile properties, this will go into the db and will
+    # be viewable on the standings page
+    players[w]['games'] += 1
+    players[w]['win'] += 1
+    players[w]['win_streak'] += 1
+    players[w]['loss_streak'] = 0
+    players[l]['games'] += 1
+    players[l]['loss'] += 1
+    players[l]['win_streak'] = 0
+    players[l]['loss_streak'] += 1
+
+    # finally, record the match with trueskill and let it calculate ranks
+    (players[w]['rating'], players[l]['rating']) = kernel.rate(
+        players[w]['rating'], players[l]['rating'])
+
+
+def sort_players(kernel, players):
+    """
+    Returns ranking profiles ordered from best to worst. Ties are broken by
+    user key so that the order never depends on how profiles were loaded.
+    """
+    return sorted(
+        players.values(), reverse=True,
+        key=lambda p: (kernel.env.expose(p['rating']), p['id']))
+
+
+def player_from_ranking(kernel, row):
+    """
+    Converts a stored ranking record back into a ranking profile.
+    """
+    return {
+        'id': row['user_key'], 'win': row['wins'], 'loss': row['losses'],
+        'win_streak': row['win_streak'], 'loss_streak': row['loss_streak'],
+        'games': row['games'],
+        'rating': kernel.create_rating(float(row['mu']), float(row['sigma']))}
+
+
+def ranking_fields(league_key, rank, p):
+    """
+    Converts a ranking profile into ranking record fields.
+    """
+    return {
+        'league_key': league_key, 'user_key': p['id'], 'rank': rank,
+        'mu': p['rating'].mu, 'sigma': p['rating'].sigma,
+        'wins': p['win'], 'losses': p['loss'], 'win_streak': p['win_streak'],
+        'loss_streak': p['loss_streak'], 'games': p['games']}
+
+
+def logger():
+    """
+    Returns the logger used to report ranking rebuilds.
+    """
+    return getLogger('rankings')
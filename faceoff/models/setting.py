@@ -4,29 +4,30 @@ License: MIT, see LICENSE for details
 """
 
 from faceoff.db import use_db
+from faceoff.models.generation import Snapshot
 
 
-@use_db
-def get_setting(db, name, default=None):
-    setting = db.find('setting', name=name)
-    if setting is None:
-        return default
-    return setting['value']
+def get_setting(name, default=None, db=None):
+    """
+    Returns the value of a setting. All settings are loaded into memory once
+    and served from there until one of them changes.
+    """
+    return settings.get(db).get(name, default)
 
 
 @use_db
 def set_setting(db, name, value=None):
-    setting = db.find('setting', name=name)
-    if setting is None:
-        query = 'INSERT INTO setting (value, name) VALUES (?, ?)'
-    else:
-        query = 'UPDATE setting SET value=? WHERE name=?'
-    db.execute(query, (value, name))
+    db.execute("""
+        INSERT INTO setting (name, value) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET value=excluded.value
+        """, (name, value))
+    settings.invalidate(db)
 
 
 @use_db
 def del_setting(db, name):
     db.execute('DELETE FROM setting WHERE name=?', (name,))
+    settings.invalidate(db)
 
 
 @use_db
@@ -35,3 +36,10 @@ def set_access_code(db, code):
         del_setting(db, 'access_code')
     else:
         set_setting(db, 'access_code', code)
+
+
+@use_db
+def load_settings(db):
+    return dict((row['name'], row['value']) for row in db.search('setting'))
+
+settings = Snapshot('setting', load_settings)
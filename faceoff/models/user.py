@@ -8,6 +8,9 @@ from random import choice
 from time import time
 from hashlib import sha1
 from faceoff.db import use_db, Expr
+from faceoff.cache import cached, bump_version
+from faceoff.models.league import get_all_leagues
+from faceoff.models.generation import bump_generation
 
 RANK_ADMIN = 'admin'
 RANK_MEMBER = 'member'
@@ -18,6 +21,21 @@ def find_user(db, **kwargs):
     return db.find('user', **kwargs)
 
 
+@cached('get_user_snapshot', namespace='user')
+@use_db
+def get_user_snapshot(db, user_id):
+    """
+    Returns the public profile of a user, without the password hash. This is
+    what authenticated requests see as the current user, so it is cached
+    until `update_user` changes the user.
+    """
+    user = find_user(db, id=user_id)
+    if user is None:
+        return None
+    fields = ('id', 'nickname', 'rank', 'date_created')
+    return dict((k, user[k]) for k in fields)
+
+
 @use_db
 def find_user_id(db, nickname):
     user = db.find('user', nickname=nickname)
@@ -35,8 +53,29 @@ def get_all_users(db):
 
 
 @use_db
-def get_active_users(db):
-    return search_users(db, sort=Expr('UPPER(nickname)'), order='asc')
+def get_active_users(db, limit=None):
+    return search_users(
+        db, sort=Expr('nickname COLLATE NOCASE'), order='asc', limit=limit)
+
+
+@use_db
+def find_users_by_prefix(db, prefix, limit=10):
+    """
+    Returns the users whose nickname starts with `prefix`, ignoring case, in
+    nickname order. Reads a range of the case insensitive nickname index.
+    """
+    if not prefix:
+        return []
+    # NOCASE compares nicknames with ASCII letters in lower case, so the
+    # upper bound is taken from the prefix folded the same way.
+    prefix = ''.join(c.lower() if c < u'\x80' else c for c in prefix)
+    upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    return db.select("""
+        SELECT id, nickname FROM user
+        WHERE nickname >= ? COLLATE NOCASE AND nickname < ? COLLATE NOCASE
+        ORDER BY nickname COLLATE NOCASE ASC
+        LIMIT ?
+        """, [prefix, upper, limit])
 
 
 @use_db
@@ -47,13 +86,15 @@ def create_user(db, nickname, password, rank=None):
     salt = generate_salt()
     password = sha1(password + salt).hexdigest()
     rank = rank if rank in [RANK_MEMBER, RANK_ADMIN] else RANK_MEMBER
-    return db.insert(
+    user_id = db.insert(
         'user',
         nickname=nickname,
         password=password,
         salt=salt,
         rank=rank,
         date_created=int(time()))
+    bump_generation(db, 'users')
+    return user_id
 
 
 @use_db
@@ -67,7 +108,14 @@ def update_user(db, user_id, nickname=None, password=None):
     if password is not None and password != '':
         fields['salt'] = generate_salt()
         fields['password'] = sha1(password + fields['salt']).hexdigest()
-    db.update('user', user_id, **fields)
+    with db.transaction():
+        db.update('user', user_id, **fields)
+        bump_version('user', user_id, db=db)
+        if 'nickname' in fields:
+            # cached standings and match history show nicknames.
+            bump_version('league', *[l['id'] for l in get_all_leagues(db)],
+                         db=db)
+            bump_generation(db, 'users')
     return find_user(db, id=user_id)
 
 
@@ -81,15 +129,27 @@ def auth_login(db, session, nickname, password):
     NOTE: If the application grows, this will likely need to be moved into a
     model that is exclusively responsible for auth management.
     """
+    user_id = check_login(db, nickname, password)
+    if user_id is None:
+        return False
+    session['user_id'] = user_id
+    session.permanent = True
+    return True
+
+
+@use_db
+def check_login(db, nickname, password):
+    """
+    Returns the ID of the user with the given nickname and password, or None
+    if they don't match a user.
+    """
     user = db.find('user', nickname=nickname)
     if user is None:
-        return False
+        return None
     password = sha1(password + user['salt']).hexdigest()
     if password != user['password']:
-        return False
-    session['user_id'] = user['id']
-    session.permanent = True
-    return True
+        return None
+    return user['id']
 
 
 def auth_logout(session):
@@ -0,0 +1,110 @@
+"""
+Per-request SQL profiler. Collects every statement executed while handling
+a request, logs slow statements along with their query plan, and reports a
+summary to admins.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+import sqlite3
+from logging import getLogger
+from collections import deque
+from threading import Lock
+from flask import g, has_request_context
+from faceoff.db import statement_listeners
+from faceoff.models.user import RANK_ADMIN
+
+_explainable = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def init_app(app):
+    """
+    Enables the profiler if the app is configured for it. Requires traced
+    database connections, which the database layer opens whenever the
+    profiler is enabled.
+    """
+    if not app.config['SQL_PROFILER']:
+        app.profiler = None
+        return
+    app.profiler = Profiler(app.config['SQL_SLOW_THRESHOLD'])
+    statement_listeners.append(app.profiler.on_statement)
+    app.after_request(app.profiler.add_summary_header)
+
+
+class Profiler(object):
+    """
+    Records the statements of the current request into `g.sql_profile`.
+    Statements slower than `threshold` seconds are written into the `db.slow`
+    logger with their `EXPLAIN QUERY PLAN` output, and the most recent ones
+    are kept for the admin page.
+    """
+
+    def __init__(self, threshold, keep=50):
+        self.threshold = threshold
+        self.slow_queries = deque(maxlen=keep)
+        self.lock = Lock()
+
+    def on_statement(self, conn, sql, params, elapsed):
+        if has_request_context():
+            if not hasattr(g, 'sql_profile'):
+                g.sql_profile = []
+            g.sql_profile.append({'sql': sql, 'elapsed': elapsed})
+        if elapsed >= self.threshold:
+            self.log_slow_query(conn, sql, params, elapsed)
+
+    def log_slow_query(self, conn, sql, params, elapsed):
+        plan = explain(conn, sql, params)
+        logger().warning('%.4fs: %s\n%s' % (
+            elapsed, ' '.join(sql.split()), '\n'.join(plan)))
+        with self.lock:
+            self.slow_queries.appendleft(
+                {'sql': sql, 'elapsed': elapsed, 'plan': plan})
+
+    def get_slow_queries(self):
+        with self.lock:
+            return list(self.slow_queries)
+
+    def add_summary_header(self, response):
+        """
+        Adds an `X-SQL-Profile` header summarizing the statements of the
+        request when the current user is an admin.
+        """
+        profile = getattr(g, 'sql_profile', None)
+        user = getattr(g, 'current_user', None)
+        if profile and user is not None and user['rank'] == RANK_ADMIN:
+            response.headers['X-SQL-Profile'] = summarize(profile)
+        return response
+
+
+def summarize(profile):
+    """
+    Returns a one line summary of a request profile.
+    """
+    total = sum(s['elapsed'] for s in profile)
+    slowest = max(profile, key=lambda s: s['elapsed'])
+    return '%d queries; %.2fms total; slowest %.2fms: %s' % (
+        len(profile), total * 1000, slowest['elapsed'] * 1000,
+        ' '.join(slowest['sql'].split())[:200])
+
+
+def explain(conn, sql, params):
+    """
+    Returns the `EXPLAIN QUERY PLAN` lines of a statement. The plan is
+    fetched through a plain cursor so that it isn't profiled itself.
+    """
+    if params is None or not sql.strip().upper().startswith(_explainable):
+        return []
+    try:
+        cursor = sqlite3.Cursor(conn)
+        rows = cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+        return [row[-1] for row in rows.fetchall()]
+    except sqlite3.Error as e:
+        return ['plan unavailable: %s' % e]
+
+
+def logger():
+    """
+    Returns the slow query logger.
+    """
+    return getLogger('db.slow')
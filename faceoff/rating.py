@@ -0,0 +1,66 @@
+"""
+Closed-form TrueSkill rating update for a single 1-v-1 match.
+
+Every faceoff match is played between two players and can't end in a draw.
+For that case the TrueSkill factor graph has a single truncation factor and
+converges after one pass, so its result can be computed directly instead of
+building and solving the graph for every match.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+from math import sqrt
+from collections import namedtuple
+from trueskill import calc_draw_margin
+
+
+class Rating(namedtuple('Rating', ['mu', 'sigma'])):
+    """
+    A player's skill rating. Unlike `trueskill.Rating`, which converts to and
+    from precision form, `mu` and `sigma` are kept exactly as given so that
+    stored ratings read back as the same values.
+    """
+
+
+class WinLossKernel(object):
+    """
+    Rates 1-v-1 win/loss matches using the constants of a TrueSkill
+    environment. Produces the same ratings as `TrueSkill.rate` up to floating
+    point rounding.
+    """
+
+    def __init__(self, env):
+        if callable(env.draw_probability):
+            raise ValueError('dynamic draw probability is not supported')
+        self.env = env
+        self.tau_sq = env.tau ** 2
+        self.beta_sq = 2 * env.beta ** 2
+        self.draw_margin = calc_draw_margin(env.draw_probability, 2, env)
+
+    def create_rating(self, mu=None, sigma=None):
+        """
+        Returns a new rating, defaulting to the environment's initial rating.
+        """
+        return Rating(
+            self.env.mu if mu is None else mu,
+            self.env.sigma if sigma is None else sigma)
+
+    def rate(self, winner, loser):
+        """
+        Returns the new `(winner, loser)` ratings after `winner` beat `loser`.
+        """
+        env = self.env
+        winner_sq = winner.sigma ** 2 + self.tau_sq
+        loser_sq = loser.sigma ** 2 + self.tau_sq
+        c_sq = winner_sq + loser_sq + self.beta_sq
+        c = sqrt(c_sq)
+        diff = (winner.mu - loser.mu) / c
+        margin = self.draw_margin / c
+        v = env.v_win(diff, margin)
+        w = env.w_win(diff, margin)
+        return (
+            Rating(winner.mu + winner_sq / c * v,
+                   sqrt(winner_sq * (1 - winner_sq / c_sq * w))),
+            Rating(loser.mu - loser_sq / c * v,
+                   sqrt(loser_sq * (1 - loser_sq / c_sq * w))))
@@ -0,0 +1,14 @@
+/**
+ * Adds the time each league last changed, which is when its newest match was
+ * reported, its rankings rebuilt or its settings changed. League pages use
+ * it to answer conditional requests.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+ALTER TABLE league ADD COLUMN date_modified REAL;
+UPDATE league SET date_modified = COALESCE(
+    (SELECT MAX(date_created) FROM match WHERE match.league_key = league.key),
+    date_created);
+UPDATE setting SET value='1.10' WHERE name='schema_version';
@@ -0,0 +1,17 @@
+/**
+ * Replays matches played in the same second in the order they were
+ * recorded. The replay index is ordered by match key right after the date,
+ * instead of by the players, and makes the index on the league and date
+ * redundant. Checkpoints were taken in the old order and are dropped, so the
+ * next rebuild recreates them.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+DROP INDEX idx_match_league_replay;
+CREATE INDEX idx_match_league_replay ON match (
+    league_key, date_created, key, winner_key, loser_key);
+DROP INDEX idx_match_league_newest;
+DELETE FROM ranking_checkpoint;
+UPDATE setting SET value='1.11' WHERE name='schema_version';
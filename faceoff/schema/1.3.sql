@@ -0,0 +1,23 @@
+/**
+ * Adds periodic ranking checkpoints. A checkpoint stores every player's
+ * ranking profile after all league matches played up to `date_created`, so
+ * that rankings can be rebuilt by replaying only the matches after it.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+CREATE TABLE ranking_checkpoint (
+    league_id CHAR(32),
+    date_created INT(11),
+    user_id CHAR(32),
+    mu VARCHAR(64),
+    sigma VARCHAR(64),
+    wins INT(5),
+    losses INT(5),
+    win_streak INT(5),
+    loss_streak INT(5),
+    games INT(6),
+    PRIMARY KEY (league_id, date_created, user_id)
+    );
+UPDATE setting SET value='1.3' WHERE name='schema_version';
@@ -0,0 +1,11 @@
+/**
+ * Adds a covering index for replaying league matches in the order they were
+ * played when rankings are rebuilt.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+CREATE INDEX idx_match_league_replay ON match (
+    league_id, date_created, winner_id, loser_id);
+UPDATE setting SET value='1.4' WHERE name='schema_version';
@@ -0,0 +1,15 @@
+/**
+ * Adds league scoped match indexes. League history is read newest first and
+ * paged by (date_created, id), and per-user history is read through either
+ * side of the match.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+CREATE INDEX idx_match_league_newest ON match (league_id, date_created, id);
+CREATE INDEX idx_match_league_winner ON match (
+    league_id, winner_id, date_created, id);
+CREATE INDEX idx_match_league_loser ON match (
+    league_id, loser_id, date_created, id);
+UPDATE setting SET value='1.5' WHERE name='schema_version';
@@ -0,0 +1,25 @@
+/**
+ * Adds a row for each side of every match, so that the history of a single
+ * player is read from one index instead of matching either side of a match.
+ * `result` is 1 for a win and 0 for a loss.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+CREATE TABLE match_participant (
+    league_id CHAR(32),
+    user_id CHAR(32),
+    date_created INT(11),
+    match_id CHAR(32),
+    result INT(1),
+    PRIMARY KEY (league_id, user_id, date_created, match_id)
+    );
+INSERT INTO match_participant
+    (league_id, user_id, date_created, match_id, result)
+    SELECT league_id, winner_id, date_created, id, 1 FROM match;
+INSERT INTO match_participant
+    (league_id, user_id, date_created, match_id, result)
+    SELECT league_id, loser_id, date_created, id, 0 FROM match
+    WHERE loser_id != winner_id;
+UPDATE setting SET value='1.6' WHERE name='schema_version';
@@ -0,0 +1,140 @@
+/**
+ * Compacts storage. Users, leagues and matches get an integer `key` that
+ * replaces the 32 character hex ids in every column and index that refers to
+ * them, while the hex `id` stays as the public identifier. Ratings are stored
+ * as REAL. The tables are rebuilt in place and the existing data is copied
+ * over. Checkpoints are derived data and are dropped: matches played in the
+ * same second now replay in key order, so the next rebuild recreates them.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+CREATE TABLE user_new (
+    key INTEGER PRIMARY KEY,
+    id CHAR(32) NOT NULL,
+    nickname VARCHAR(25),
+    password CHAR(40),
+    salt CHAR(8),
+    rank VARCHAR(16),
+    date_created INT(11)
+    );
+INSERT INTO user_new (id, nickname, password, salt, rank, date_created)
+    SELECT id, nickname, password, salt, rank, date_created FROM user
+    ORDER BY date_created, id;
+DROP TABLE user;
+ALTER TABLE user_new RENAME TO user;
+CREATE UNIQUE INDEX idx_user_id ON user (id);
+CREATE UNIQUE INDEX idx_user_unique ON user (nickname);
+CREATE INDEX idx_user_newest ON user (date_created);
+
+CREATE TABLE league_new (
+    key INTEGER PRIMARY KEY,
+    id CHAR(32) NOT NULL,
+    slug CHAR(64),
+    name VARCHAR(64),
+    description TEXT DEFAULT NULL,
+    active TINYINT(1) DEFAULT 1,
+    date_created INT(11)
+    );
+INSERT INTO league_new (id, slug, name, description, active, date_created)
+    SELECT id, slug, name, description, active, date_created FROM league
+    ORDER BY date_created, id;
+DROP TABLE league;
+ALTER TABLE league_new RENAME TO league;
+CREATE UNIQUE INDEX idx_league_id ON league (id);
+CREATE INDEX idx_league_slug ON league (slug);
+CREATE INDEX idx_league_newest ON league (date_created);
+
+CREATE TABLE match_new (
+    key INTEGER PRIMARY KEY,
+    id CHAR(32) NOT NULL,
+    league_key INTEGER,
+    winner_key INTEGER,
+    winner_rank INTEGER DEFAULT NULL,
+    loser_key INTEGER,
+    loser_rank INTEGER DEFAULT NULL,
+    date_created INT(11),
+    draw_prob REAL,
+    winner_mu REAL,
+    winner_sigma REAL,
+    loser_mu REAL,
+    loser_sigma REAL
+    );
+INSERT INTO match_new (
+    id, league_key, winner_key, winner_rank, loser_key, loser_rank,
+    date_created, draw_prob, winner_mu, winner_sigma, loser_mu, loser_sigma)
+    SELECT match.id, league.key, winner.key, CAST(winner_rank AS INTEGER),
+        loser.key, CAST(loser_rank AS INTEGER), match.date_created,
+        CAST(draw_prob AS REAL), CAST(winner_mu AS REAL),
+        CAST(winner_sigma AS REAL), CAST(loser_mu AS REAL),
+        CAST(loser_sigma AS REAL)
+    FROM match
+    INNER JOIN league ON league.id = match.league_id
+    INNER JOIN user AS winner ON winner.id = match.winner_id
+    INNER JOIN user AS loser ON loser.id = match.loser_id
+    ORDER BY match.league_id, match.date_created, match.id;
+DROP TABLE match;
+ALTER TABLE match_new RENAME TO match;
+CREATE UNIQUE INDEX idx_match_id ON match (id);
+CREATE INDEX idx_match_league_newest ON match (league_key, date_created);
+CREATE INDEX idx_match_league_replay ON match (
+    league_key, date_created, winner_key, loser_key);
+
+CREATE TABLE ranking_new (
+    league_key INTEGER,
+    user_key INTEGER,
+    rank INT(4),
+    wins INT(5),
+    losses INT(5),
+    win_streak INT(5),
+    loss_streak INT(5),
+    games INT(6),
+    mu REAL,
+    sigma REAL,
+    PRIMARY KEY (league_key, user_key)
+    ) WITHOUT ROWID;
+INSERT INTO ranking_new (
+    league_key, user_key, rank, wins, losses, win_streak, loss_streak, games,
+    mu, sigma)
+    SELECT league.key, user.key, ranking.rank, wins, losses, win_streak,
+        loss_streak, games, CAST(mu AS REAL), CAST(sigma AS REAL)
+    FROM ranking
+    INNER JOIN league ON league.id = ranking.league_id
+    INNER JOIN user ON user.id = ranking.user_id;
+DROP TABLE ranking;
+ALTER TABLE ranking_new RENAME TO ranking;
+CREATE INDEX idx_ranking_league_best ON ranking (league_key, rank);
+
+DROP TABLE ranking_checkpoint;
+CREATE TABLE ranking_checkpoint (
+    league_key INTEGER,
+    date_created INT(11),
+    user_key INTEGER,
+    mu REAL,
+    sigma REAL,
+    wins INT(5),
+    losses INT(5),
+    win_streak INT(5),
+    loss_streak INT(5),
+    games INT(6),
+    PRIMARY KEY (league_key, date_created, user_key)
+    ) WITHOUT ROWID;
+
+DROP TABLE match_participant;
+CREATE TABLE match_participant (
+    league_key INTEGER,
+    user_key INTEGER,
+    date_created INT(11),
+    match_key INTEGER,
+    result INT(1),
+    PRIMARY KEY (league_key, user_key, date_created, match_key)
+    ) WITHOUT ROWID;
+INSERT INTO match_participant
+    (league_key, user_key, date_created, match_key, result)
+    SELECT league_key, winner_key, date_created, key, 1 FROM match;
+INSERT INTO match_participant
+    (league_key, user_key, date_created, match_key, result)
+    SELECT league_key, loser_key, date_created, key, 0 FROM match
+    WHERE loser_key != winner_key;
+UPDATE setting SET value='1.7' WHERE name='schema_version';
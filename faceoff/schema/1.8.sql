@@ -0,0 +1,14 @@
+/**
+ * Adds generation counters. A generation is bumped whenever the data it
+ * covers changes, so that processes holding an in-memory copy of that data
+ * know to reload it.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+CREATE TABLE generation (
+    name CHAR(32) PRIMARY KEY,
+    value INTEGER DEFAULT 0
+    );
+UPDATE setting SET value='1.8' WHERE name='schema_version';
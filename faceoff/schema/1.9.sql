@@ -0,0 +1,10 @@
+/**
+ * Adds a case insensitive nickname index. The match report form lists users
+ * in nickname order and searches them by nickname prefix.
+ * 
+ * Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+ * License: MIT, see LICENSE for details
+ */
+
+CREATE INDEX idx_user_nickname_nocase ON user (nickname COLLATE NOCASE);
+UPDATE setting SET value='1.9' WHERE name='schema_version';
@@ -25,6 +25,29 @@ jQuery(function($) {
         $('#report button[type=submit]').attr('disabled', false);
     }, 2000);
 
+    // opponent search, lists the matching users in the opponent select
+    var search = $('#opponent-search'), searchTimer;
+    search.keyup(function() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(function() {
+            var q = $.trim(search.val()),
+                select = $('#report select[name=opponent]');
+            if (!q) {
+                return;
+            }
+            $.getJSON(search.attr('data-source'), {q: q}, function(data) {
+                select.empty();
+                $.each(data.users, function(i, user) {
+                    $('<option>').val(user.id).text(user.nickname)
+                        .appendTo(select);
+                });
+                if (!data.users.length) {
+                    $('<option>').val('').text('- -').appendTo(select);
+                }
+            });
+        }, 250);
+    });
+
     // history filter
     $('#history-filter select').change(function() {
         var sel = $(this),
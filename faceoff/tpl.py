@@ -3,14 +3,57 @@ Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
 License: MIT, see LICENSE for details
 """
 
-from datetime import datetime
+from datetime import datetime, date
 from time import localtime, strftime, mktime
+from jinja2 import nodes, Markup
+from jinja2.ext import Extension
+from faceoff.cache import get_global_cache
 
 _filters = {}
 
 
 def init_app(app):
     app.jinja_env.filters.update(_filters)
+    app.jinja_env.add_extension(FragmentCache)
+    app.jinja_env.globals['today'] = date.today
+
+
+class FragmentCache(Extension):
+    """
+    Adds a tag that caches the rendered output of a template block:
+
+        {% cache 'standings', current_league.id, current_user.id %}
+            ...
+        {% endcache %}
+
+    The first argument names the fragment and the second is the id of the
+    league it shows, so the fragment is cached under that league's version
+    and is invalidated along with the league's cached data. Any further
+    arguments are part of the cache key and should cover everything else the
+    block depends on, such as the current user.
+    """
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('render', [nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def render(self, args, caller):
+        cache = get_global_cache()
+        if cache is None:
+            return caller()
+        (name, league_id, params) = (args[0], args[1], args[2:])
+        name = 'fragment:%s' % name
+        version = cache.version('league:%s' % league_id)
+        key = cache.make_key(name, version, params)
+        return Markup(cache.load(
+            name, key, lambda: unicode(caller()), versioned=True))
 
 
 def template_filter(f):
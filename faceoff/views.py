@@ -7,35 +7,46 @@ import os
 from datetime import datetime, date
 from time import mktime
 from flask import (
-    g, request, session, flash, abort, redirect, url_for, send_from_directory)
+    g, request, session, flash, abort, redirect, url_for, send_from_directory,
+    jsonify)
+from werkzeug.datastructures import CombinedMultiDict
 from faceoff import app
+from faceoff.db import release_connection, get_connection, query_stats
 from faceoff.forms import (
     LoginForm, JoinForm, ReportForm, NewLeagueForm, SettingsForm, ProfileForm,
-    AdminForm)
-from faceoff.helpers.decorators import authenticated, templated
+    AdminForm, ImportForm)
+from faceoff.helpers.decorators import (
+    authenticated, templated, readonly, conditional)
 from faceoff.models.user import (
-    get_active_users, create_user, update_user, auth_login, auth_logout,
-    find_user_id)
-from faceoff.models.league import \
-    find_league, get_active_leagues, get_inactive_leagues, create_league, \
-    update_league
-from faceoff.models.match import \
-    create_match, search_matches, get_league_ranking, get_user_standing, \
-    rebuild_rankings, find_older_match, find_newer_match
+    create_user, update_user, auth_login, auth_logout, find_user_id,
+    find_users_by_prefix, RANK_ADMIN)
+from faceoff.models.league import (
+    get_league_by_slug, get_active_leagues, get_inactive_leagues,
+    create_league, update_league, get_all_leagues)
+from faceoff.models.match import (
+    search_matches, get_league_ranking, get_user_standing, rebuild_rankings,
+    rebuild_all_rankings, find_older_match, find_newer_match, get_opponents)
 from faceoff.models.setting import get_setting, set_access_code
+from faceoff.importer import import_matches
+from faceoff.writer import ReportTimeout
 
 
 @app.teardown_request
 def db_close(exception):
-    if hasattr(g, 'db'):
-        g.db.close()
+    release_connection()
+
+
+@app.url_value_preprocessor
+def select_db_mode(endpoint, view_args):
+    view = app.view_functions.get(endpoint)
+    g.db_readonly = getattr(view, 'readonly', False)
 
 
 @app.url_value_preprocessor
 def get_league_from_url(endpoint, view_args):
     if not view_args or 'league' not in view_args:
         return
-    league = find_league(slug=view_args.pop('league'))
+    league = get_league_by_slug(view_args.pop('league'))
     if league is None:
         abort(404)
     g.current_league = league
@@ -102,6 +113,7 @@ def join():
 
 
 @app.route('/')
+@readonly
 @templated()
 @authenticated
 def landing():
@@ -149,20 +161,76 @@ def admin():
     form = AdminForm(request.form)
     if request.method != 'POST' or not form.validate():
         form.access_code.data = get_setting('access_code')
-        return dict(admin_form=form)
+        return dict(admin_form=form,
+                    import_form=ImportForm(get_all_leagues()))
     set_access_code(form.access_code.data.strip())
     flash('Settings saved')
     return redirect(url_for('admin'))
 
 
-@app.route('/<league>/')
+@app.route('/admin/queries')
+@readonly
 @templated()
 @authenticated
+def admin_queries():
+    if g.current_user['rank'] != RANK_ADMIN:
+        abort(403)
+    return dict(
+        tracing=app.db.trace,
+        pool_stats=app.db.pool_stats(),
+        cache_stats=app.cache.get_stats(),
+        query_stats=query_stats.dump()[:50],
+        slow_queries=app.profiler.get_slow_queries() if app.profiler else [])
+
+
+@app.route('/admin/rebuild', methods=('POST',))
+@authenticated
+def rebuild_all():
+    if g.current_user['rank'] != RANK_ADMIN:
+        abort(403)
+    count = rebuild_all_rankings()
+    flash('Standings rebuilt for %d leagues' % count)
+    return redirect(url_for('admin'))
+
+
+@app.route('/admin/import', methods=('POST',))
+@authenticated
+def import_all():
+    if g.current_user['rank'] != RANK_ADMIN:
+        abort(403)
+    form = ImportForm(
+        get_all_leagues(), CombinedMultiDict((request.files, request.form)))
+    if not form.validate():
+        flash('Choose a league and a CSV file to import')
+        return redirect(url_for('admin'))
+    try:
+        result = import_matches(
+            get_connection(), form.league.data, form.matches.data.stream)
+    except ValueError as e:
+        flash('Import failed: %s' % e)
+        return redirect(url_for('admin'))
+    flash('Imported %d matches (%.0f rows/s), skipped %d' % (
+        result['imported'], result['rate'], result['skipped']))
+    for (line, error) in result['errors'][:5]:
+        flash('Skipped line %d: %s' % (line, error.decode('utf-8')))
+    return redirect(url_for('admin'))
+
+
+@app.route('/<league>/')
+@readonly
+@authenticated
+@conditional
+@templated()
 def dashboard():
     user = g.current_user
     league = g.current_league
+    limit = app.config['REPORT_OPPONENTS']
+    opponents = get_opponents(
+        league['id'], user['id'], limit,
+        recent=app.config['REPORT_RECENT_OPPONENTS'])
     return dict(
-        report_form=ReportForm(get_active_users()),
+        report_form=ReportForm(user['id'], opponents=opponents),
+        opponent_search=len(opponents) == limit,
         current_ranking=get_user_standing(league['id'], user['id']),
         ranking=get_league_ranking(league['id']),
         history=search_matches(league['id'], user_id=user['id']))
@@ -174,20 +242,40 @@ def dashboard():
 def report():
     if not g.current_league['active']:
         abort(403)
-    form = ReportForm(get_active_users(), request.form)
+    form = ReportForm(g.current_user['id'], request.form)
     if not form.validate():
         return dict(form=form)
     is_win = form.result.data == '1'
     cur_user = g.current_user['id']
     opp_user = form.opponent.data
     (winner, loser) = (cur_user, opp_user) if is_win else (opp_user, cur_user)
-    create_match(g.current_league['id'], winner, loser)
+    try:
+        app.writer.report(g.current_league['id'], winner, loser)
+    except ReportTimeout:
+        flash('The match was not recorded, please try again')
+    except ValueError as e:
+        flash('The match was not recorded: %s' % e)
     return redirect(url_for('dashboard'))
 
 
+@app.route('/<league>/opponents')
+@readonly
+@authenticated
+def opponents():
+    """
+    Searches opponents by nickname prefix for the match report form.
+    """
+    users = find_users_by_prefix(request.args.get('q', '').strip(), limit=10)
+    return jsonify(users=[
+        dict(id=u['id'], nickname=u['nickname']) for u in users
+        if u['id'] != g.current_user['id']])
+
+
 @app.route('/<league>/standings/')
-@templated()
+@readonly
 @authenticated
+@conditional
+@templated()
 def standings():
     return dict(ranking=get_league_ranking(g.current_league['id']))
 
@@ -200,8 +288,10 @@ def standings():
 @app.route('/<league>/history/<nickname>/<int:year>/', defaults={'month': None, 'day': None})  # noqa
 @app.route('/<league>/history/<nickname>/<int:year>/<month>/', defaults={'day': None})  # noqa
 @app.route('/<league>/history/<nickname>/<int:year>/<month>/<int:day>')
-@templated()
+@readonly
 @authenticated
+@conditional
+@templated()
 def history(nickname, year, month, day):
     league_id = g.current_league['id']
     user_id = find_user_id(nickname) if nickname is not None else None
@@ -0,0 +1,204 @@
+"""
+Funnels match reports through a single writer thread. Reports that arrive
+within a short window of each other are recorded in one transaction, with
+one ranking update per league, instead of each request taking the exclusive
+lock and updating the rankings on its own.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+import os
+from logging import getLogger
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+from time import time
+from faceoff.models.match import create_match, create_matches
+
+
+def init_app(app):
+    """
+    Attaches a `writer` property to the app object that queues match reports
+    for the app's database.
+    """
+    app.writer = MatchWriter(
+        app.db,
+        window=app.config['REPORT_BATCH_WINDOW'],
+        batch_size=app.config['REPORT_BATCH_SIZE'],
+        timeout=app.config['REPORT_TIMEOUT'])
+
+
+class MatchWriter(object):
+    """
+    Records queued match reports from a dedicated thread. The thread is
+    started on the first report submitted by each process.
+    """
+
+    def __init__(self, factory, window=0.05, batch_size=50, timeout=30):
+        self.factory = factory
+        self.window = window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.lock = Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+
+    def submit(self, league_id, winner_user_id, loser_user_id,
+               match_date=None):
+        """
+        Queues a match report and returns a `Report` that can be waited on
+        for the new match id.
+        """
+        report = Report(league_id, winner_user_id, loser_user_id, match_date)
+        self.start()
+        self.queue.put(report)
+        return report
+
+    def report(self, *args, **kwargs):
+        """
+        Queues a match report and waits until it has been recorded. Returns
+        the new match id. Raises `ReportTimeout` if the writer did not pick
+        up the report within the timeout, in which case it is never recorded.
+        """
+        return self.submit(*args, **kwargs).wait(self.timeout)
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue()
+            self.thread = Thread(target=self.run, name='match-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        db = self.factory.connect()
+        while True:
+            batch = [r for r in self.collect() if r.claim()]
+            if not batch:
+                continue
+            try:
+                self.write(db, batch)
+            except Exception as e:
+                logger().exception('match writer failed')
+                [report.finish(error=e) for report in batch if not report.done]
+
+    def collect(self):
+        """
+        Waits for a report, then gathers any others that arrive within the
+        batch window.
+        """
+        batch = [self.queue.get()]
+        deadline = time() + self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def write(self, db, batch):
+        """
+        Records a batch of reports in a single transaction. If that fails,
+        each report is retried on its own so that only the reports at fault
+        fail.
+        """
+        started = time()
+        try:
+            # only errors raised before the commit are caught, so a batch is
+            # retried only when none of its reports were recorded.
+            with db.transaction():
+                match_ids = create_matches(db, [r.match for r in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].finish(error=e)
+                return
+            logger().warning('batch of %d reports failed, retrying each: %s'
+                             % (len(batch), e))
+            for report in batch:
+                try:
+                    report.finish(match_id=create_match(db, *report.match))
+                except Exception as e:
+                    report.finish(error=e)
+            return
+        for (report, match_id) in zip(batch, match_ids):
+            report.finish(match_id=match_id)
+        logger().debug('recorded %d reports in %.3fs'
+                       % (len(batch), time() - started))
+
+
+class ReportTimeout(RuntimeError):
+    """
+    Raised when a report was given up on before the writer picked it up. The
+    report is dropped, so it is safe to submit it again.
+    """
+
+
+class Report(object):
+    """
+    A queued match report. Holds the outcome once the writer is done.
+    """
+
+    def __init__(self, league_id, winner_user_id, loser_user_id, match_date):
+        self.match = (league_id, winner_user_id, loser_user_id, match_date)
+        self.match_id = None
+        self.error = None
+        self.event = Event()
+        self.lock = Lock()
+        self.claimed = False
+        self.cancelled = False
+
+    @property
+    def done(self):
+        return self.event.is_set()
+
+    def claim(self):
+        """
+        Called by the writer before recording the report. Returns False if
+        the report was cancelled.
+        """
+        with self.lock:
+            self.claimed = not self.cancelled
+            return self.claimed
+
+    def cancel(self):
+        """
+        Drops the report unless the writer has already claimed it. Returns
+        whether it was dropped.
+        """
+        with self.lock:
+            self.cancelled = not self.claimed
+            return self.cancelled
+
+    def finish(self, match_id=None, error=None):
+        self.match_id = match_id
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the report has been recorded and returns the new match
+        id. Re-raises the error if recording it failed. If the writer has not
+        claimed the report within `timeout` the report is cancelled and
+        `ReportTimeout` is raised. Once claimed, the report is waited on
+        until the writer is done with it, since it may already be committed.
+        """
+        if not self.event.wait(timeout):
+            if self.cancel():
+                raise ReportTimeout('timed out waiting for match report')
+            self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.match_id
+
+
+def logger():
+    """
+    Returns the logger used by the match writer.
+    """
+    return getLogger('writer')
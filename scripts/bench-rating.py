@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+
+"""
+Compares the closed-form 1-v-1 rating kernel with the generic TrueSkill
+factor graph. Replays the same random matches through both, then reports the
+time per match and the largest relative difference between the ratings.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+from sys import path
+from os.path import dirname, join
+
+path.append(join(dirname(__file__), '..'))
+
+from argparse import ArgumentParser
+parser = ArgumentParser(usage='%(prog)s [options]')
+parser.add_argument('--matches', metavar='<int>', type=int, default=20000)
+parser.add_argument('--players', metavar='<int>', type=int, default=50)
+parser.add_argument('--seed', metavar='<int>', type=int, default=0)
+args = parser.parse_args()
+
+from random import Random
+from time import time
+from trueskill import TrueSkill
+from faceoff.rating import WinLossKernel
+
+env = TrueSkill()
+kernel = WinLossKernel(env)
+rand = Random(args.seed)
+matches = [rand.sample(xrange(args.players), 2) for x in xrange(args.matches)]
+
+
+def replay(rate):
+    ratings = [env.create_rating() for x in xrange(args.players)]
+    started = time()
+    for (w, l) in matches:
+        ratings[w], ratings[l] = rate(ratings[w], ratings[l])
+    return ratings, time() - started
+
+
+def rate_graph(winner, loser):
+    ((winner,), (loser,)) = env.rate([(winner,), (loser,)])
+    return winner, loser
+
+graph, graph_time = replay(rate_graph)
+closed, closed_time = replay(kernel.rate)
+error = max(
+    abs(a - b) / abs(b)
+    for (x, y) in zip(closed, graph)
+    for (a, b) in [(x.mu, y.mu), (x.sigma, y.sigma)])
+
+print('%d matches between %d players' % (args.matches, args.players))
+print('factor graph: %8.2f us/match' % (graph_time / args.matches * 1e6))
+print('closed form:  %8.2f us/match' % (closed_time / args.matches * 1e6))
+print('speedup:      %8.1fx' % (graph_time / closed_time))
+print('max relative difference: %.3g' % error)
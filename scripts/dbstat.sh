@@ -16,4 +16,4 @@ query "select * from setting;"
 query "select * from user;"
 query "select id, slug, name, active, date_created from league;"
 query "select * from match;"
-query "select * from ranking order by league_id asc, rank asc;"
+query "select * from ranking order by league_key asc, rank asc;"
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+
+"""
+Runs Faceoff maintenance commands against a database.
+
+Copyright: (c) 2012-2014 Artem Nezvigin <artem@artnez.com>
+License: MIT, see LICENSE for details
+"""
+
+from sys import path, stdin, stdout, stderr, exit
+from os import environ
+from os.path import dirname, join
+from time import time
+
+path.append(join(dirname(__file__), '..'))
+
+from argparse import ArgumentParser
+parser = ArgumentParser(usage='%(prog)s [options] <command> [command options]')
+parser.add_argument('--config', metavar='<string>', dest='FACEOFF_CONFIG')
+parser.add_argument('--db-path', metavar='<string>', dest='FACEOFF_DB_PATH')
+parser.add_argument('--log-path', metavar='<string>', dest='FACEOFF_LOG_PATH')
+parser.add_argument('--log-level', metavar='<string>', dest='FACEOFF_LOG_LEVEL')
+commands = parser.add_subparsers(dest='command', metavar='<command>')
+
+rebuild_parser = commands.add_parser('rebuild', help='rebuild the standings of every league')
+rebuild_parser.add_argument('--processes', metavar='<int>', type=int, help='worker processes to use (default: one per cpu)')
+
+size_parser = commands.add_parser('size', help='show the space used by each table and index')
+
+export_parser = commands.add_parser('export', help='write the match history of a league to stdout')
+export_parser.add_argument('league', metavar='<slug>', help='league to export')
+export_parser.add_argument('--format', metavar='<string>', choices=('csv', 'ndjson'), default='csv', help='csv or ndjson (default: csv)')
+
+import_parser = commands.add_parser('import', help='import matches into a league from csv')
+import_parser.add_argument('league', metavar='<slug>', help='league to import into')
+import_parser.add_argument('file', metavar='<file>', help='csv file with winner, loser and time played columns, or - for stdin')
+import_parser.add_argument('--batch-size', metavar='<int>', type=int, default=1000, help='matches inserted per statement (default: 1000)')
+
+args = parser.parse_args()
+environ.update(dict(
+    (k, v) for (k, v) in vars(args).items() if k.startswith('FACEOFF_') and v))
+
+from faceoff import app
+
+
+def rebuild(db):
+    from faceoff.models.match import rebuild_all_rankings
+    started = time()
+    count = rebuild_all_rankings(db, processes=args.processes)
+    print('rebuilt %d leagues in %.2fs' % (count, time() - started))
+
+
+def size(db):
+    from faceoff.db import get_storage_stats
+    stats = get_storage_stats(db)
+    for (name, kind, size) in stats['objects']:
+        print('%-32s %-8s %10d' % (name, kind, size))
+    print('%-32s %-8s %10d' % ('total', '', stats['size']))
+
+
+def export(db):
+    from faceoff.export import export_matches
+    from faceoff.models.league import find_league
+    league = find_league(db, slug=args.league)
+    if league is None:
+        exit('no league at %s' % args.league)
+    for chunk in export_matches(db, league['id'], args.format):
+        stdout.write(chunk)
+
+
+def import_(db):
+    from faceoff.importer import import_matches
+    from faceoff.models.league import find_league
+    league = find_league(db, slug=args.league)
+    if league is None:
+        exit('no league at %s' % args.league)
+
+    def progress(count, rate):
+        stderr.write('imported %d matches (%.0f rows/s)\n' % (count, rate))
+    f = stdin if args.file == '-' else open(args.file, 'rb')
+    try:
+        result = import_matches(db, league['id'], f, args.batch_size, progress)
+    except ValueError as e:
+        exit(str(e))
+    finally:
+        f.close()
+    for (line, error) in result['errors']:
+        stderr.write('skipped line %d: %s\n' % (line, error))
+    print('imported %d matches, skipped %d, in %.2fs' % (
+        result['imported'], result['skipped'], result['elapsed']))
+
+
+db = app.db.connect()
+try:
+    handlers = {
+        'rebuild': rebuild, 'size': size, 'export': export, 'import': import_}
+    handlers[args.command](db)
+finally:
+    db.close()
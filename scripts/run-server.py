@@ -21,6 +21,8 @@ parser.add_argument('--config', metavar='<string>', dest='FACEOFF_CONFIG')
 parser.add_argument('--debug', action='store_const', const='1', dest='FACEOFF_DEBUG')
 parser.add_argument('--db-path', metavar='<string>', dest='FACEOFF_DB_PATH')
 parser.add_argument('--db-fixtures', action='store_const', const='1', dest='FACEOFF_DB_FIXTURES')
+parser.add_argument('--db-trace', action='store_const', const='1', dest='FACEOFF_DB_TRACE')
+parser.add_argument('--sql-profiler', action='store_const', const='1', dest='FACEOFF_SQL_PROFILER')
 parser.add_argument('--log-path', metavar='<string>', dest='FACEOFF_LOG_PATH')
 parser.add_argument('--log-level', metavar='<string>', dest='FACEOFF_LOG_LEVEL')
 parser.add_argument('--log-filter', metavar='<string>', dest='FACEOFF_LOG_FILTER')